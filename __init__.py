@@ -1,6 +1,7 @@
 import bpy
 import os
-from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty
+from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty, \
+        CollectionProperty
 
 from bpy_extras.io_utils import ExportHelper, ImportHelper
 bl_info = {
@@ -23,6 +24,11 @@ class ImportBMD(bpy.types.Operator, ImportHelper):
     filename_ext = ".bmd"
     filter_glob = StringProperty(default="*.bmd", options={"HIDDEN"})
 
+    background_textures = BoolProperty(name="Decode Textures in Background",
+            description="Create the model right away and fill in its textures once " +
+                "they've been decoded",
+            default=False)
+
     @property
     def check_extension(self):
         return True
@@ -32,9 +38,40 @@ class ImportBMD(bpy.types.Operator, ImportHelper):
             raise Exception("filepath not set")
 
         from . import import_bmd
-        return import_bmd.load(context, self.filepath)
+        return import_bmd.load(context, self.filepath,
+                background_textures=self.background_textures)
     
 
+class ImportBMDBatch(bpy.types.Operator, ImportHelper):
+    """Import several BMDs, sharing textures and materials between them"""
+    bl_idname = "import_scene.bmd_batch"
+    bl_label = "Import BMDs"
+    bl_options = {"PRESET"}
+
+    filename_ext = ".bmd"
+    filter_glob = StringProperty(default="*.bmd", options={"HIDDEN"})
+
+    files = CollectionProperty(type=bpy.types.OperatorFileListElement,
+            options={"HIDDEN", "SKIP_SAVE"})
+    directory = StringProperty(subtype="DIR_PATH")
+
+    use_processes = BoolProperty(name="Decode Textures in Parallel",
+            description="Decode textures in separate processes",
+            default=True)
+
+    def execute(self, context):
+        # With no files selected, import every BMD in the directory
+        filenames = [f.name for f in self.files if f.name] or \
+                sorted(f for f in os.listdir(self.directory) if f.lower().endswith(".bmd"))
+        if not filenames:
+            raise Exception("no files selected")
+
+        from . import import_bmd
+        return import_bmd.load_batch(context,
+                [os.path.join(self.directory, f) for f in filenames],
+                use_processes=self.use_processes)
+
+
 class ExportBMD(bpy.types.Operator, ExportHelper):
     """Selection to BMD"""
     bl_idname = "export_scene.bmd"
@@ -47,6 +84,13 @@ class ExportBMD(bpy.types.Operator, ExportHelper):
     sm256 = BoolProperty(name="SM256-specific BMD",
             description="Export a SM256-specific BMD, which includes range and range offset Y",
             default="SM256_ROOT" in os.environ)
+    quantize_vertices = BoolProperty(name="Merge Quantized Vertices",
+            description="Merge vertices that are identical at the precision they're stored in",
+            default=True)
+    report = BoolProperty(name="Write Report",
+            description="Write a JSON report of section sizes and VRAM, polygon and vertex " +
+                "usage next to the BMD, and print a summary to the console",
+            default=False)
 
     @property
     def check_extension(self):
@@ -77,6 +121,28 @@ class ExportBCA(bpy.types.Operator, ExportHelper):
     filename_ext = ".bca"
     filter_glob = StringProperty(default="*.bca", options={"HIDDEN"})
 
+    all_actions = BoolProperty(name="Export All Actions",
+            description="Export each of the armature's actions, including those of its " +
+                "NLA strips, over its own frame range to <action name>.bca in the " +
+                "chosen directory",
+            default=False)
+    pack = BoolProperty(name="Pack Values",
+            description="Overlap the runs of values of the channels as much as possible, " +
+                "which makes the animation smaller but takes longer",
+            default=False)
+    scale_tolerance = FloatProperty(name="Scale Tolerance",
+            description="How far off stored scales may be, so that channels can be " +
+                "stored with fewer keyframes",
+            default=0.0, min=0.0)
+    rotation_tolerance = FloatProperty(name="Rotation Tolerance",
+            description="How far off stored rotations may be in degrees, so that " +
+                "channels can be stored with fewer keyframes",
+            default=0.0, min=0.0)
+    translation_tolerance = FloatProperty(name="Translation Tolerance",
+            description="How far off stored translations may be, so that channels can be " +
+                "stored with fewer keyframes",
+            default=0.0, min=0.0)
+
     @property
     def check_extension(self):
         return True
@@ -86,7 +152,33 @@ class ExportBCA(bpy.types.Operator, ExportHelper):
             raise Exception("filepath not set")
 
         from . import export_bca
-        return export_bca.save(context, self.filepath)
+        return export_bca.save(context, self.filepath,
+                all_actions=self.all_actions,
+                scale_tolerance=self.scale_tolerance,
+                rotation_tolerance=self.rotation_tolerance,
+                translation_tolerance=self.translation_tolerance,
+                pack=self.pack)
+
+
+class ImportBCA(bpy.types.Operator, ImportHelper):
+    """BCA to the active armature"""
+    bl_idname = "import_scene.bca"
+    bl_label = "Import BCA"
+    bl_options = {"PRESET"}
+
+    filename_ext = ".bca"
+    filter_glob = StringProperty(default="*.bca", options={"HIDDEN"})
+
+    @property
+    def check_extension(self):
+        return True
+
+    def execute(self, context):
+        if not self.filepath:
+            raise Exception("filepath not set")
+
+        from . import import_bca
+        return import_bca.load(context, self.filepath)
 
 
 class ImportKCL(bpy.types.Operator, ImportHelper):
@@ -124,6 +216,13 @@ class ExportKCL(bpy.types.Operator, ExportHelper):
     one_clps_index = BoolProperty(name="Use CLPS index 0",
             description="Have all faces use CLPS index 0",
             default=False)
+    use_processes = BoolProperty(name="Build Octree in Parallel",
+            description="Build the octree in separate processes",
+            default=True)
+    share_suffixes = BoolProperty(name="Share Triangle Lists",
+            description="Reorder the triangles of each octree leaf so that leaves can " +
+                "share the ends of their lists, which makes the octree smaller",
+            default=False)
 
     @property
     def check_extension(self):
@@ -153,10 +252,18 @@ def import_menu_func(self, context):
     self.layout.operator(ImportBMD.bl_idname, text="NDS Binary Model Format (.bmd)")
 
 
+def import_batch_menu_func(self, context):
+    self.layout.operator(ImportBMDBatch.bl_idname, text="NDS Binary Model Format, batch (.bmd)")
+
+
 def export_bca_menu_func(self, context):
     self.layout.operator(ExportBCA.bl_idname, text="NDS Binary Character Animation (.bca)")
 
 
+def import_bca_menu_func(self, context):
+    self.layout.operator(ImportBCA.bl_idname, text="NDS Binary Character Animation (.bca)")
+
+
 def export_kcl_menu_func(self, context):
     self.layout.operator(ExportKCL.bl_idname, text="NDS K. Collision Format (.kcl)")
 
@@ -169,8 +276,10 @@ def register():
     bpy.utils.register_module(__name__)
 
     bpy.types.INFO_MT_file_import.append(import_menu_func)
+    bpy.types.INFO_MT_file_import.append(import_batch_menu_func)
     bpy.types.INFO_MT_file_export.append(export_menu_func)
     bpy.types.INFO_MT_file_export.append(export_bca_menu_func)
+    bpy.types.INFO_MT_file_import.append(import_bca_menu_func)
     bpy.types.INFO_MT_file_import.append(import_kcl_menu_func)
     bpy.types.INFO_MT_file_export.append(export_kcl_menu_func)
 
@@ -179,8 +288,10 @@ def unregister():
     bpy.utils.unregister_module(__name__)
 
     bpy.types.INFO_MT_file_import.remove(import_menu_func)
+    bpy.types.INFO_MT_file_import.remove(import_batch_menu_func)
     bpy.types.INFO_MT_file_export.remove(export_menu_func)
     bpy.types.INFO_MT_file_export.remove(export_bca_menu_func)
+    bpy.types.INFO_MT_file_import.remove(import_bca_menu_func)
     bpy.types.INFO_MT_file_import.remove(import_kcl_menu_func)
     bpy.types.INFO_MT_file_export.remove(export_kcl_menu_func)
 
@@ -0,0 +1,97 @@
+import mmap
+import os
+import struct
+
+# Doesn't import bpy, so files can be inspected outside of Blender.
+
+class MappedFile:
+    def __init__(self, filepath):
+        """
+        Maps the file into memory. bytestr is a memoryview of the whole file, so
+        slicing it doesn't copy anything. Use as a context manager, or call close().
+        """
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bytestr = memoryview(self.mmap)
+
+    def close(self):
+        self.bytestr.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass # Views into the file are still around. The mapping closes when they're gone.
+        self.file.close()
+
+    def cstr(self, offset):
+        """ Returns the null-terminated ASCII string at the offset """
+        if not 0 <= offset < len(self.bytestr):
+            raise ValueError("String at {} is outside the file".format(hex(offset)))
+        end = self.mmap.find(b"\0", offset)
+        if end < 0:
+            raise ValueError("Unterminated string at " + hex(offset))
+        return bytes(self.bytestr[offset : end]).decode("ascii")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BmdFile(MappedFile):
+    # Maps table name to (header offset of the table's count and offset, size of an entry)
+    TABLES = {
+        "bones": (0x4, 0x40),
+        "display_lists": (0xc, 0x8),
+        "textures": (0x14, 0x14),
+        "palettes": (0x1c, 0x10),
+        "materials": (0x24, 0x30),
+    }
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self.scale_factor = struct.unpack_from("<I", self.bytestr, 0)[0]
+        self.transform_bone_map_offset = struct.unpack_from("<I", self.bytestr, 0x2c)[0]
+
+    def table(self, name):
+        """ Returns a list of memoryviews of the entries of the table. Raises ValueError
+        if the table doesn't fit in the file, as in compressed or corrupt files. """
+        header_offset, entry_size = BmdFile.TABLES[name]
+        count, offset = struct.unpack_from("<II", self.bytestr, header_offset)
+        if offset + count * entry_size > len(self.bytestr):
+            raise ValueError("The {} table ({} entries at {}) doesn't fit in the file".format(
+                name, count, hex(offset)))
+        return [self.bytestr[offset + i * entry_size : offset + (i + 1) * entry_size]
+                for i in range(count)]
+
+
+def file_key(filepath):
+    """ Returns a key that changes whenever the file does """
+    stat = os.stat(filepath)
+    return (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+
+
+class ParseCache:
+    def __init__(self, max_files):
+        """
+        Keeps the parsed contents of the last max_files files, keyed by file_key,
+        so files that didn't change since they were last read don't get parsed again.
+        """
+        self.max_files = max_files
+        self.entries = [] # [(key, parsed)], least recently used first
+
+    def get(self, filepath, parse):
+        """ Returns the parsed contents of the file, calling parse() if the
+        file isn't in the cache or has changed since. """
+        key = file_key(filepath)
+        for i, (k, parsed) in enumerate(self.entries):
+            if k == key:
+                self.entries.append(self.entries.pop(i))
+                return parsed
+
+        self.entries = [(k, p) for k, p in self.entries if k[0] != key[0]]
+        parsed = parse()
+        self.entries.append((key, parsed))
+        del self.entries[:-self.max_files]
+        return parsed
@@ -0,0 +1,147 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import struct
+import sys
+
+# Doesn't import bpy, so asset libraries can be audited outside of Blender:
+#   python bmd_scan.py <directory> [-o summary.csv] [-j summary.json]
+# Only the header tables and names are read. Geometry and pixels are never decoded.
+try:
+    from .bmd_reader import BmdFile
+    from . import tex_util
+except ImportError:
+    from bmd_reader import BmdFile
+    import tex_util
+
+TEXTURE_FORMATS = {
+    tex_util.A3I5: "A3I5",
+    tex_util.COLOR_4: "COLOR_4",
+    tex_util.COLOR_16: "COLOR_16",
+    tex_util.COLOR_256: "COLOR_256",
+    tex_util.COMPRESSED: "COMPRESSED",
+    tex_util.A5I3: "A5I3",
+    tex_util.COLOR_DIRECT: "COLOR_DIRECT",
+}
+
+CSV_FIELDS = ["path", "scale_factor", "num_bones", "num_display_lists", "num_materials",
+        "num_textures", "num_palettes", "texture_vram", "palette_vram", "texture_formats",
+        "error"]
+
+def scan_texture(bmd, tex_bytes):
+    name_offset, _, size, width, height, tex_param = struct.unpack_from("<IIIHHI", tex_bytes)
+    type_ = tex_param >> 26 & 7
+    if type_ == tex_util.COMPRESSED:
+        size = size * 3 // 2 # Includes the palette indexes
+
+    return {"name": bmd.cstr(name_offset),
+            "format": TEXTURE_FORMATS.get(type_, hex(type_)),
+            "width": width,
+            "height": height,
+            "transparency": bool(tex_param >> 29 & 1),
+            "vram": size}
+
+def scan_palette(bmd, pal_bytes):
+    name_offset, _, size = struct.unpack_from("<III", pal_bytes)
+    return {"name": bmd.cstr(name_offset), "vram": size}
+
+def scan_material(bmd, material_bytes):
+    name_offset, texture_id, palette_id = struct.unpack_from("<Iii", material_bytes)
+    return {"name": bmd.cstr(name_offset), "texture_id": texture_id, "palette_id": palette_id}
+
+def scan_bone(bmd, bone_bytes):
+    name_offset = struct.unpack_from("<I", bone_bytes, 4)[0]
+    num_pairs = struct.unpack_from("<I", bone_bytes, 0x30)[0]
+    return {"name": bmd.cstr(name_offset), "num_pairs": num_pairs}
+
+def scan(filepath):
+    """ Returns a dict describing the BMD file at filepath. If the file can't be read,
+    the dict has an "error" entry instead. """
+    info = {"path": filepath}
+    try:
+        with BmdFile(filepath) as bmd:
+            info["scale_factor"] = bmd.scale_factor
+            info["bones"] = [scan_bone(bmd, b) for b in bmd.table("bones")]
+            info["num_display_lists"] = len(bmd.table("display_lists"))
+            info["textures"] = [scan_texture(bmd, t) for t in bmd.table("textures")]
+            info["palettes"] = [scan_palette(bmd, p) for p in bmd.table("palettes")]
+            info["materials"] = [scan_material(bmd, m) for m in bmd.table("materials")]
+    except Exception as e:
+        info["error"] = "{}: {}".format(type(e).__name__, e)
+    return info
+
+def summary_row(info):
+    """ Returns the CSV row for the info returned by scan """
+    row = {"path": info["path"], "error": info.get("error", "")}
+    if "error" in info:
+        return row
+
+    formats = {}
+    for tex in info["textures"]:
+        formats[tex["format"]] = formats.get(tex["format"], 0) + 1
+
+    row.update({
+        "scale_factor": info["scale_factor"],
+        "num_bones": len(info["bones"]),
+        "num_display_lists": info["num_display_lists"],
+        "num_materials": len(info["materials"]),
+        "num_textures": len(info["textures"]),
+        "num_palettes": len(info["palettes"]),
+        "texture_vram": sum(t["vram"] for t in info["textures"]),
+        "palette_vram": sum(p["vram"] for p in info["palettes"]),
+        "texture_formats": ";".join("{}:{}".format(f, n) for f, n in sorted(formats.items())),
+    })
+    return row
+
+def find_bmds(directory):
+    """ Returns the paths of all BMD files in the directory tree, sorted """
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        paths += [os.path.join(dirpath, f) for f in filenames if f.lower().endswith(".bmd")]
+    return sorted(paths)
+
+def scan_all(paths, processes=None):
+    """ Scans the files in parallel. Returns the infos in the same order as the paths. """
+    if len(paths) <= 1:
+        return [scan(p) for p in paths]
+
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(scan, paths,
+                chunksize=max(1, len(paths) // (4 * (os.cpu_count() or 1))))
+
+def write_csv(infos, file):
+    writer = csv.DictWriter(file, CSV_FIELDS)
+    writer.writeheader()
+    for info in infos:
+        writer.writerow(summary_row(info))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarizes the BMD files in a directory tree")
+    parser.add_argument("directory")
+    parser.add_argument("-o", "--csv", help="CSV file to write a row per file to " +
+            "(default: standard output)")
+    parser.add_argument("-j", "--json", help="JSON file to write the full details to")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of processes to scan with (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    infos = scan_all(find_bmds(args.directory), args.processes)
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            write_csv(infos, f)
+    else:
+        write_csv(infos, sys.stdout)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(infos, f, indent=4)
+
+    errors = sum("error" in info for info in infos)
+    if errors:
+        print("{} of {} files couldn't be read".format(errors, len(infos)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,135 @@
+import bpy
+import os
+import re
+import numpy as np
 from .util import *
-from math import degrees
+from mathutils import Euler, Matrix, Quaternion
+
+class ValuePool:
+    # Length of the longest prefixes that get indexed
+    MAX_PREFIX = 4
+
+    def __init__(self, bytes_per_elem):
+        """
+        A list of values that runs of values get stored in, reusing any
+        existing occurrence of a run.
+        values: [int]
+        prefixes: [{(int): [int]}] maps each run of k values to the indexes it occurs at,
+            in prefixes[k - 1]
+        """
+        self.bytes_per_elem = bytes_per_elem
+        self.values = []
+        self.prefixes = [{} for _ in range(ValuePool.MAX_PREFIX)]
+
+    def find(self, vals):
+        """ Returns the index of the first occurrence of vals, or -1 if there isn't one """
+        k = min(len(vals), ValuePool.MAX_PREFIX)
+        for index in self.prefixes[k - 1].get(tuple(vals[:k]), []):
+            if self.values[index : index + len(vals)] == vals:
+                return index
+        return -1
+
+    def add(self, vals):
+        """ Returns the index of vals in the pool, appending them if they aren't there """
+        index = self.find(vals)
+        if index != -1:
+            return index
+
+        index = len(self.values)
+        self.values += vals
+        # Index the runs that end in the new values
+        for start in range(max(0, index - ValuePool.MAX_PREFIX + 1), len(self.values)):
+            for k in range(max(1, index - start + 1), ValuePool.MAX_PREFIX + 1):
+                if start + k > len(self.values):
+                    break
+                self.prefixes[k - 1].setdefault(
+                        tuple(self.values[start : start + k]), []).append(start)
+        return index
+
+    def export(self):
+        return from_vec(self.values, self.bytes_per_elem, 0)
+
+
+def overlap(a, b):
+    """ Returns the length of the longest proper suffix of a that's a prefix of b """
+    for k in range(min(len(a), len(b)) - 1, 0, -1):
+        if a[-k] == b[0] and a[-k:] == b[:k]:
+            return k
+    return 0
+
+def contains(a, b):
+    """ Returns whether the run a contains the run b """
+    return any(a[i] == b[0] and a[i : i + len(b)] == b for i in range(len(a) - len(b) + 1))
+
+def superstring(runs):
+    """
+    Returns a list of values that contains every run, found by greedily merging the
+    pair of runs that overlap the most. Not always the shortest such list,
+    but usually close to it.
+    runs: [(int)]
+    """
+    # Runs inside other runs come along for free
+    runs = sorted(set(runs), key=lambda run: (-len(run), run))
+    kept = []
+    for run in runs:
+        if not any(contains(k, run) for k in kept):
+            kept.append(run)
+
+    pairs = sorted(((overlap(a, b), i, j) for i, a in enumerate(kept)
+            for j, b in enumerate(kept) if i != j), reverse=True)
+    # Chains of runs, each overlapping the next
+    succ = [None] * len(kept)
+    pred = [None] * len(kept)
+    head = list(range(len(kept))) # first run in each run's chain
+    for k, i, j in pairs:
+        if k == 0:
+            break
+        if succ[i] is None and pred[j] is None and head[i] != j:
+            succ[i] = j
+            pred[j] = i
+            # Runs in j's chain now start where i's chain does
+            run = j
+            while run is not None:
+                head[run] = head[i]
+                run = succ[run]
+
+    values = []
+    for start in range(len(kept)):
+        if pred[start] is None:
+            run, k = start, 0
+            while run is not None:
+                values += kept[run][k:]
+                k = overlap(kept[run], kept[succ[run]]) if succ[run] is not None else 0
+                run = succ[run]
+    return values
+
 
 class AnimDesc:
-    def __init__(self, vals, bytes_per_elem):
-        self.vals = vals
+    def __init__(self, vals, bytes_per_elem, tolerance=0):
+        """
+        vals: numpy array of the encoded values of each frame
+        tolerance: int is how far off the stored values may be from vals
+        """
         self.one = False
         self.interp = False
         self.bytes_per_elem = bytes_per_elem
 
-        if all(v == vals[0] for v in vals):
-            self.vals = [self.vals[0]]
+        # The middle value is within tolerance of all the values
+        if vals.max() - vals.min() <= 2 * tolerance:
+            vals = np.array([(vals.max() + vals.min()) // 2])
             self.one = True
 
         # interpolation range
         ir = (len(vals) - 1) // 2 * 2 + 1
-        if not self.one and all(v1 == (v0 + v2) // 2 for v0, v1, v2 in
-                zip(vals[0:ir-2:2], vals[1:ir-1:2], vals[2:ir:2])):
-            del self.vals[1:ir-1:2]
+        if not self.one and (np.abs(vals[1:ir-1:2] -
+                (vals[0:ir-2:2] + vals[2:ir:2]) // 2) <= tolerance).all():
+            vals = np.delete(vals, np.arange(1, ir - 1, 2))
             self.interp = True
 
-        self.bytestr = from_vec(self.vals, bytes_per_elem, 0)
-
-    def add_to_bytearr(self, bytearr):
-        self.index = -2
-        while not (self.index == -1 or 
-                (self.index >= 0 and self.index % self.bytes_per_elem == 0)):
-            self.index = bytearr.find(self.bytestr)
-
-        if self.index == -1: # Not found
-            self.index = len(bytearr)
-            bytearr += self.bytestr
+        self.vals = vals.tolist()
 
-        self.index //= self.bytes_per_elem # index, not offset
+    def add_to_pool(self, pool):
+        self.index = pool.add(self.vals)
 
     def export(self):
         bytestr = bytearray()
@@ -41,44 +139,223 @@ class AnimDesc:
         return bytestr
 
 
-class AnimBone:
-    def __init__(self, transforms):
-        self.scales = [m.to_scale() for m in transforms]
-        self.rots = [[degrees(e) for e in m.to_euler("XYZ")] for m in transforms]
-        self.transs = [m.to_translation() for m in transforms]
+def decompose(mtxs):
+    """ Returns (scales, rotations, translations) where each is an array of the
+    x, y, z of the transforms in mtxs, an array of 4x4 matrices.
+    Rotations are XYZ Euler angles in radians, chosen like Matrix.to_euler("XYZ"). """
+    mat = mtxs[..., 0:3, 0:3]
+    scales = np.sqrt((mat ** 2).sum(axis=-2))
+    mat = mat / np.where(scales > 0, scales, 1)[..., None, :]
+
+    # Of the two Euler angles for each matrix, the one with the smaller sum
+    cy = np.hypot(mat[..., 0, 0], mat[..., 1, 0])
+    eul1 = np.stack([np.arctan2(mat[..., 2, 1], mat[..., 2, 2]),
+            np.arctan2(-mat[..., 2, 0], cy),
+            np.arctan2(mat[..., 1, 0], mat[..., 0, 0])], axis=-1)
+    eul2 = np.stack([np.arctan2(-mat[..., 2, 1], -mat[..., 2, 2]),
+            np.arctan2(-mat[..., 2, 0], -cy),
+            np.arctan2(-mat[..., 1, 0], -mat[..., 0, 0])], axis=-1)
+    rotations = np.where((np.abs(eul1).sum(axis=-1) > np.abs(eul2).sum(axis=-1))[..., None],
+            eul2, eul1)
+
+    # Gimbal lock
+    locked = cy <= 16 * np.finfo(np.float32).eps
+    rotations[locked, 0] = np.arctan2(-mat[locked, 1, 2], mat[locked, 1, 1])
+    rotations[locked, 1] = np.arctan2(-mat[locked, 2, 0], cy[locked])
+    rotations[locked, 2] = 0
 
-        scales_xyz = [[fix_to_int(v[i], 12) for v in self.scales] for i in range(3)]
-        rots_xyz = [[deg_to_int(v[i]) for v in self.rots] for i in range(3)]
-        transs_xyz = [[fix_to_int(v[i], 12) for v in self.transs] for i in range(3)]
+    return scales, rotations, mtxs[..., 0:3, 3]
 
-        self.descs = [AnimDesc(vs, bpe) for vs, bpe in 
-                zip(scales_xyz + rots_xyz + transs_xyz, [4, 4, 4, 2, 2, 2, 4, 4, 4])]
+def encode_channels(mtxs):
+    """ Returns an int array of the scale x, y, z, rotation x, y, z and translation x, y, z
+    of each frame of each bone, as stored in a BCA, indexed by bone, channel and frame.
+    mtxs: array of 4x4 matrices indexed by frame and bone """
+    scales, rotations, translations = decompose(np.asarray(mtxs, dtype=np.float64))
+    rotations = np.floor(np.degrees(rotations) * 65536 / 360 + 0.5).astype(np.int64)
+    channels = np.concatenate([
+        np.floor(scales * 4096 + 0.5).astype(np.int64),
+        (rotations + 0x8000) % 0x10000 - 0x8000, # 180 degrees is the same as -180
+        np.floor(translations * 4096 + 0.5).astype(np.int64)], axis=-1)
+    return channels.transpose(1, 2, 0)
 
-    def add_to_bytestrs(self, scale_bytestr, rot_bytestr, trans_bytestr):
-        for desc, b in zip(self.descs,
-                [scale_bytestr] * 3 + [rot_bytestr] * 3 + [trans_bytestr] * 3):
-            desc.add_to_bytearr(b)
+
+def channel_tolerances(scale_tolerance, rotation_tolerance, translation_tolerance):
+    """ Returns the tolerance of each channel in encoded units.
+    rotation_tolerance is in degrees. """
+    return [int(scale_tolerance * 4096)] * 3 + \
+            [int(rotation_tolerance * 65536 / 360)] * 3 + \
+            [int(translation_tolerance * 4096)] * 3
+
+
+class AnimBone:
+    def __init__(self, channels, tolerances=None):
+        """ channels: int array of the values of each channel at each frame,
+        as returned by encode_channels for a bone
+        tolerances: [int] as returned by channel_tolerances, or None to store the values
+        exactly """
+        self.descs = [AnimDesc(vs, bpe, tol) for vs, bpe, tol in 
+                zip(channels, [4, 4, 4, 2, 2, 2, 4, 4, 4], tolerances or [0] * 9)]
+
+    def add_to_pools(self, scale_pool, rot_pool, trans_pool):
+        for desc, pool in zip(self.descs,
+                [scale_pool] * 3 + [rot_pool] * 3 + [trans_pool] * 3):
+            desc.add_to_pool(pool)
 
     def export(self):
         return b"".join(desc.export() for desc in self.descs)
     
 
-def export_anim(context, obj):
+class ActionSampler:
+    # Pose bone properties that F-curves can animate, and how many values they have
+    PROPERTIES = {"location": 3, "rotation_quaternion": 4, "rotation_euler": 3, "scale": 3}
+
+    def __init__(self, obj):
+        """
+        Samples an armature's pose by evaluating an action's F-curves and composing
+        the bone matrices from the rest pose and the parent chain, without evaluating
+        the scene. Only valid if can_sample() is True. The bone order and rest matrices
+        are worked out once, so several actions can be sampled with the same sampler.
+        curves: {bpy.types.Action: {(str, str): {int: bpy.types.FCurve}}} maps
+            (bone name, property) to the F-curve of each animated index, for each action
+        """
+        self.obj = obj
+        self.curves = {}
+
+        # Parents before children
+        self.order = sorted(range(len(obj.pose.bones)),
+                key=lambda i: len(obj.pose.bones[i].parent_recursive))
+        self.parents = [obj.pose.bones.find(b.parent.name) if b.parent else -1
+                for b in obj.pose.bones]
+        # Rest matrix of each bone relative to its parent
+        self.rests = [b.parent.bone.matrix_local.inverted() * b.bone.matrix_local \
+                if b.parent else b.bone.matrix_local.copy() for b in obj.pose.bones]
+
+        # Drivers, constraints and bones that don't simply inherit their parent's
+        # transform need the scene to be evaluated.
+        anim = obj.animation_data
+        self.simple = not (anim and len(anim.drivers) > 0) and \
+                not any(len(b.constraints) > 0 or b.rotation_mode == "AXIS_ANGLE" or
+                    not b.bone.use_inherit_rotation or not b.bone.use_inherit_scale or
+                    not b.bone.use_local_location for b in obj.pose.bones)
+
+    def action_curves(self, action):
+        if action not in self.curves:
+            self.curves[action] = {}
+            for fcurve in action.fcurves if action else []:
+                match = re.match(r'pose\.bones\["(.*)"\]\.(\w+)$', fcurve.data_path)
+                if match and match.group(2) in ActionSampler.PROPERTIES and not fcurve.mute:
+                    self.curves[action].setdefault((match.group(1), match.group(2)), {}) \
+                            [fcurve.array_index] = fcurve
+        return self.curves[action]
+
+    def can_sample(self, alone=False):
+        """ Returns whether sampling gives the same matrices as setting the frame would.
+        If alone is False, the object's own action is sampled the way the scene plays it,
+        so NLA tracks and action blending need the scene to be evaluated too. """
+        anim = self.obj.animation_data
+        if not alone and anim and (anim.action_blend_type != "REPLACE" or
+                anim.action_influence != 1 or
+                (anim.use_nla and any(not t.mute for t in anim.nla_tracks))):
+            return False
+        return self.simple
+
+    def values(self, bone, prop, frame, curves):
+        """ Returns the property's values at the frame. Indexes without an F-curve
+        keep their current values. """
+        vals = list(getattr(bone, prop))
+        for index, fcurve in curves.get((bone.name, prop), {}).items():
+            vals[index] = fcurve.evaluate(frame)
+        return vals
+
+    def basis(self, bone, frame, curves):
+        """ Returns the bone's matrix_basis at the frame. Like Blender, ignores the
+        location of connected bones. """
+        if bone.rotation_mode == "QUATERNION":
+            rotation = Quaternion(self.values(bone, "rotation_quaternion", frame, curves)) \
+                    .normalized()
+        else:
+            rotation = Euler(self.values(bone, "rotation_euler", frame, curves),
+                    bone.rotation_mode)
+        scale = self.values(bone, "scale", frame, curves)
+        location = (0, 0, 0) if bone.bone.use_connect else \
+                self.values(bone, "location", frame, curves)
+
+        return Matrix.Translation(location) * \
+                rotation.to_matrix().to_4x4() * \
+                Matrix.Scale(scale[0], 4, Vector((1, 0, 0))) * \
+                Matrix.Scale(scale[1], 4, Vector((0, 1, 0))) * \
+                Matrix.Scale(scale[2], 4, Vector((0, 0, 1)))
+
+    def sample(self, frames, action):
+        """ Returns [[Matrix]], the pose matrix of each bone at each frame """
+        bones = self.obj.pose.bones
+        curves = self.action_curves(action)
+        mtxs = []
+        for frame in frames:
+            frame_mtxs = [None] * len(bones)
+            for i in self.order:
+                parent = frame_mtxs[self.parents[i]] if self.parents[i] >= 0 else Matrix()
+                frame_mtxs[i] = parent * self.rests[i] * self.basis(bones[i], frame, curves)
+            mtxs.append(frame_mtxs)
+        return mtxs
+
+
+def sample_frames(context, obj, frames, action=None, sampler=None):
+    """ Returns [[Matrix]], the pose matrix of each bone at each frame.
+    If action is given, it's sampled on its own instead of the object's animation.
+    Only evaluates the scene if the animation can't be sampled directly. """
+    sampler = sampler or ActionSampler(obj)
+    anim = obj.animation_data
+    if sampler.can_sample(action is not None):
+        return sampler.sample(frames, action or (anim.action if anim else None))
+
+    if action:
+        prev_action, prev_use_nla = anim.action, anim.use_nla
+        anim.action, anim.use_nla = action, False
+
     mtxs = []
     fraam = context.scene.frame_current
-    for frame in range(context.scene.frame_start, context.scene.frame_end + 1):
-        context.scene.frame_set(frame)
-        mtxs.append([b.matrix.copy() for b in obj.pose.bones])
-    context.scene.frame_set(fraam)
+    try:
+        for frame in frames:
+            context.scene.frame_set(frame)
+            mtxs.append([b.matrix.copy() for b in obj.pose.bones])
+    finally:
+        if action:
+            anim.action, anim.use_nla = prev_action, prev_use_nla
+        context.scene.frame_set(fraam)
+    return mtxs
+
 
-    num_frames = len(mtxs)
-    bones = [AnimBone([m[i] for m in mtxs]) for i in range(len(obj.data.bones))]
+def matrix_array(mtxs):
+    """ Returns the matrices returned by sample_frames as a numpy array """
+    return np.array([[[list(row) for row in m] for m in frame] for frame in mtxs])
 
-    scale_bytestr = bytearray()
-    rot_bytestr = bytearray()
-    trans_bytestr = bytearray()
+
+def encode_anim(channels, tolerances=None, pack=False):
+    """ Returns (bytestr, values_size) where:
+    bytestr: bytearray is the BCA of the channels, as returned by encode_channels
+    values_size: int is the number of bytes the scale, rotation and translation values take
+    If pack is True, the runs of values are overlapped as much as possible first,
+    instead of being added in bone order.
+    """
+    num_frames = channels.shape[2]
+    bones = [AnimBone(c, tolerances) for c in channels]
+
+    scale_pool = ValuePool(4)
+    rot_pool = ValuePool(2)
+    trans_pool = ValuePool(4)
+    if pack:
+        for i, pool in enumerate([scale_pool, rot_pool, trans_pool]):
+            runs = [tuple(d.vals) for b in bones for d in b.descs[3 * i : 3 * i + 3]]
+            packed = superstring(runs)
+            # Only used if it beats adding the runs in bone order
+            in_order = ValuePool(pool.bytes_per_elem)
+            for run in runs:
+                in_order.add(list(run))
+            if len(packed) < len(in_order.values):
+                pool.add(packed)
     for bone in bones:
-        bone.add_to_bytestrs(scale_bytestr, rot_bytestr, trans_bytestr)
+        bone.add_to_pools(scale_pool, rot_pool, trans_pool)
 
     bytestr_list = BytesWithPtrs()
 
@@ -109,21 +386,97 @@ def export_anim(context, obj):
     
     bytestr_list.bytestrs.append(header_aligned)
     bytestr_list.bytestrs.append(scale_marker)
-    bytestr_list.bytestrs.append(AlignedBytes(scale_bytestr, 4))
+    bytestr_list.bytestrs.append(AlignedBytes(scale_pool.export(), 4))
     bytestr_list.bytestrs.append(rot_marker)
-    bytestr_list.bytestrs.append(AlignedBytes(rot_bytestr, 4))
+    bytestr_list.bytestrs.append(AlignedBytes(rot_pool.export(), 4))
     bytestr_list.bytestrs.append(trans_marker)
-    bytestr_list.bytestrs.append(AlignedBytes(trans_bytestr, 4))
+    bytestr_list.bytestrs.append(AlignedBytes(trans_pool.export(), 4))
     bytestr_list.bytestrs.append(anim_marker)
     bytestr_list.bytestrs.append(AlignedBytes(b"".join(b.export() for b in bones), 4))
 
     bytestr_list.ptrs += [scale_ptr, rot_ptr, trans_ptr, anim_ptr]
 
-    return bytestr_list.assemble()
+    return bytestr_list.assemble(), sum(len(p.values) * p.bytes_per_elem for p in
+            [scale_pool, rot_pool, trans_pool])
+
+
+def export_anim(context, obj, *, scale_tolerance=0.0, rotation_tolerance=0.0,
+        translation_tolerance=0.0, pack=False):
+    """ The tolerances are how far off stored values may be, so that channels can be
+    stored as constant or at half rate. rotation_tolerance is in degrees.
+    If pack is True, runs of values are overlapped to make the values smaller. """
+    mtxs = sample_frames(context, obj,
+            range(context.scene.frame_start, context.scene.frame_end + 1))
+    channels = encode_channels(matrix_array(mtxs))
+
+    tolerances = channel_tolerances(scale_tolerance, rotation_tolerance, translation_tolerance)
+    bytestr, values_size = encode_anim(channels, tolerances, pack)
+    if any(tolerances) or pack:
+        exact_size = encode_anim(channels)[1]
+        print("Keyframe reduction and packing saved {} of {} bytes of values".format(
+            exact_size - values_size, exact_size))
+
+    return bytestr
+
+
+def get_actions(obj):
+    """ Returns the object's action and the actions of its NLA strips, without repeats """
+    anim = obj.animation_data
+    if not anim:
+        return []
+
+    actions = [anim.action] if anim.action else []
+    for track in anim.nla_tracks:
+        actions += [strip.action for strip in track.strips
+                if strip.action and strip.action not in actions]
+    return actions
+
+def export_actions(context, obj, *, scale_tolerance=0.0, rotation_tolerance=0.0,
+        translation_tolerance=0.0, pack=False):
+    """ Returns [(action, bytestr)], the BCA of each of the object's actions, each
+    sampled over its own frame range. The sampler is shared, so the bone order and
+    rest matrices are only worked out once. """
+    sampler = ActionSampler(obj)
+    tolerances = channel_tolerances(scale_tolerance, rotation_tolerance, translation_tolerance)
+
+    result = []
+    for action in get_actions(obj):
+        start, end = action.frame_range
+        mtxs = matrix_array(sample_frames(context, obj,
+                range(int(start), int(end) + 1), action, sampler))
+        result.append((action, encode_anim(encode_channels(mtxs), tolerances, pack)[0]))
+    return result
+
+def save(context, filepath, *, all_actions=False, scale_tolerance=0.0, rotation_tolerance=0.0,
+        translation_tolerance=0.0, pack=False):
+    """ If all_actions is True, each of the active object's actions is exported
+    to <action name>.bca in the directory of filepath instead. """
+    if all_actions:
+        directory = os.path.dirname(filepath)
+        taken = set()
+        for action, bytestr in export_actions(context, context.active_object,
+                scale_tolerance=scale_tolerance, rotation_tolerance=rotation_tolerance,
+                translation_tolerance=translation_tolerance, pack=pack):
+            # Different actions can have the same clean name, like "Walk.L" and "Walk_L".
+            # Clean names have no dots, so the suffixes can't collide with them.
+            name = bpy.path.clean_name(action.name)
+            unique = name
+            suffix = 1
+            while unique.lower() in taken:
+                unique = "{}.{:03}".format(name, suffix)
+                suffix += 1
+            if unique != name:
+                print("{} is exported to {}.bca since {}.bca is taken".format(
+                    action.name, unique, name))
+            taken.add(unique.lower())
 
+            with open(os.path.join(directory, unique + ".bca"), "wb") as f:
+                f.write(bytestr)
+        return {"FINISHED"}
 
-def save(context, filepath):
-    bytestr = export_anim(context, context.active_object)
+    bytestr = export_anim(context, context.active_object, scale_tolerance=scale_tolerance,
+            rotation_tolerance=rotation_tolerance, translation_tolerance=translation_tolerance,
+            pack=pack)
     with open(filepath, "wb") as f:
         f.write(bytestr)
         
@@ -1,16 +1,19 @@
 import bpy
+import json
 import math
+import os
 from mathutils import Color, Vector, Matrix
 from itertools import chain
 from .util import *
 
-def export_bone(bone, bones, materials, mesh, meshes, group_names):
+def export_bone(bone, bones, materials, mesh, meshes, group_names, displist_materials):
     """ Returns (bone_data, other_data, ptrs) where:
     bone_data: AlignedBytes is the bytestring of the bone
     name_data: [AlignedBytes] is a list of relevant detached bytestrings
     ptrs: [BytesPtr] is a list of relevant pointers
     
     If bone is None, the model is exported as rooms, so mesh and meshes must be provided.
+    displist_materials: [int] is the material index of each display list
     """
     bytestr = bytearray()
     aligned = AlignedBytes(bytestr, 4)
@@ -60,12 +63,12 @@ def export_bone(bone, bones, materials, mesh, meshes, group_names):
     else:
         start = sum(len(m.materials) for m in meshes[:bone_id])
         indexes = list(range(start, start + len(materials)))
-    bytestr += from_uint(len(indexes), 4)
+    dl_indexes = [i for i, m in enumerate(displist_materials) if m in indexes]
+    bytestr += from_uint(len(dl_indexes), 4)
     bytestr += from_uint(0, 4) * 2 # placeholder pointers
 
-    ids = lambda: AlignedBytes(from_uint_list(indexes, 1), 1)
-    mat_ids = ids()
-    dl_ids = ids()
+    mat_ids = AlignedBytes(from_uint_list([displist_materials[i] for i in dl_indexes], 1), 1)
+    dl_ids = AlignedBytes(from_uint_list(dl_indexes, 1), 1)
     mat_ptr = BytesPtr(aligned, 0x34, mat_ids, 0, 4)
     dl_ptr =  BytesPtr(aligned, 0x38, dl_ids,  0, 4)
 
@@ -91,28 +94,25 @@ def add_command(dl_bytestr, command, arg, cmd_offset):
         cmd_offset = len(dl_bytestr)
     return cmd_offset
 
-def add_primitive(dl_bytestr, primitive, p_type, transform_ids, \
-        tex_size, cmd_offset, prev_vertex):
-    """ Adds the primitive to the display list bytestring and returns the new
-    command offset and previous vertex. """
-    cmd_offset = add_command(dl_bytestr, 0x40, from_uint(p_type, 4), cmd_offset)
+def vertex_commands(primitive, transform_ids, tex_size, prev_vertex):
+    """ Returns (commands, prev_vertex) where:
+    commands: [(int, bytes)] are the commands and arguments that draw the vertices
+    prev_vertex: Vertex is the new previous vertex
+    """
+    commands = []
     for v in primitive:
         if v.group != prev_vertex.group:
-            cmd_offset = add_command(dl_bytestr, 0x14, \
-                    from_uint(transform_ids.index(v.group), 4), cmd_offset)
+            commands.append((0x14, from_uint(transform_ids.index(v.group), 4)))
 
         if v.uv and v.uv != prev_vertex.uv:
-            cmd_offset = add_command(dl_bytestr, 0x22, \
-                    from_fix(v.uv[0] * tex_size[0], 2, 4) + \
-                    from_fix(v.uv[1] * tex_size[1], 2, 4), cmd_offset)
+            commands.append((0x22, from_fix(v.uv[0] * tex_size[0], 2, 4) + \
+                    from_fix(v.uv[1] * tex_size[1], 2, 4)))
 
         if v.color and v.color != prev_vertex.color:
-            cmd_offset = add_command(dl_bytestr, 0x20, \
-                    from_uint(color_to_uint16(v.color, 1), 4), cmd_offset)
+            commands.append((0x20, from_uint(color_to_uint16(v.color, 1), 4)))
 
         if v.normal and v.normal != prev_vertex.normal:
-            cmd_offset = add_command(dl_bytestr, 0x21, \
-                    from_vecb(v.normal * 511 / 512, 10, 9, 4), cmd_offset)
+            commands.append((0x21, from_vecb(v.normal * 511 / 512, 10, 9, 4)))
 
         optimized = False
         if prev_vertex.position:
@@ -123,48 +123,86 @@ def add_primitive(dl_bytestr, primitive, p_type, transform_ids, \
                 swiz = v.position.yz if index == 0 else \
                         v.position.xz if index == 1 else \
                         v.position.xy
-                cmd_offset = add_command(dl_bytestr, 0x27 - index,
-                        from_vec(swiz, 2, 12), cmd_offset)
+                commands.append((0x27 - index, from_vec(swiz, 2, 12)))
 
             # Coordinates representable without needing a lot of precision
             elif all(fix_to_int(c, 6) * 64 == fix_to_int(c, 12) for c in v.position):
                 optimized = True
-                cmd_offset = add_command(dl_bytestr, 0x24,
-                        from_vecb(v.position, 10, 6, 4), cmd_offset)
+                commands.append((0x24, from_vecb(v.position, 10, 6, 4)))
 
             # Not too far from previous vertex
             elif all(-512 <= fix_to_int(c, 12) - fix_to_int(pc, 12) < 512 for c, pc in \
                     zip(v.position, prev_vertex.position)):
                 optimized = True
-                cmd_offset = add_command(dl_bytestr, 0x28,
-                        from_vecb([fix_to_int(c, 12) - fix_to_int(pc, 12) for c, pc in \
-                                zip(v.position, prev_vertex.position)], 10, 0, 4), cmd_offset)
+                commands.append((0x28, from_vecb([fix_to_int(c, 12) - fix_to_int(pc, 12) \
+                        for c, pc in zip(v.position, prev_vertex.position)], 10, 0, 4)))
 
         if not optimized:
-            cmd_offset = add_command(dl_bytestr, 0x23, \
-                    from_vec(v.position, 2, 12) + from_uint(0, 2), cmd_offset)
+            commands.append((0x23, from_vec(v.position, 2, 12) + from_uint(0, 2)))
 
         prev_vertex = v
+
+    return commands, prev_vertex
+
+def add_primitive(dl_bytestr, primitive, p_type, transform_ids, \
+        tex_size, cmd_offset, prev_vertex):
+    """ Adds the primitive to the display list bytestring and returns the new
+    command offset and previous vertex. """
+    cmd_offset = add_command(dl_bytestr, 0x40, from_uint(p_type, 4), cmd_offset)
+    commands, prev_vertex = vertex_commands(primitive, transform_ids, tex_size, prev_vertex)
+    for command, arg in commands:
+        cmd_offset = add_command(dl_bytestr, command, arg, cmd_offset)
     
     cmd_offset = add_command(dl_bytestr, 0x41, b'', cmd_offset)
     return cmd_offset, prev_vertex
 
-def export_display_list(mesh, material, bones, group_names, scale_factor):
-    """ Returns (bone_data, other_data, ptrs) where:
-    bone_data: AlignedBytes is the bytestring of the bone
-    name_data: [AlignedBytes] is a list of relevant detached bytestrings
-    ptrs: [BytesPtr] is a list of relevant pointers
-    """
-    bytestr = bytearray()
-    aligned = AlignedBytes(bytestr, 4)
+def commands_cost(commands):
+    """ Returns about the number of bytes the commands take up in a display list.
+    Each command takes a byte in a command pack plus the bytes of its argument.
+    Padding at the end of a pack isn't counted. """
+    return sum(1 + len(arg) for _, arg in commands)
+
+def split_strip(strip, p_type):
+    """ Returns the faces of the strip as a sequence of vertices of separate
+    triangles (if p_type is 2) or quads (if p_type is 3) """
+    if p_type == 2:
+        return [v for i in range(len(strip) - 2) for v in (
+                (strip[i], strip[i + 1], strip[i + 2]) if i % 2 == 0 else
+                (strip[i + 1], strip[i], strip[i + 2]))]
+    else:
+        return [strip[i + j] for i in range(0, len(strip) - 2, 2) for j in (0, 1, 3, 2)]
+
+def choose_primitives(tri_strips, quad_strips, tris, quads, transform_ids, tex_size):
+    """ Returns (tri_strips, quad_strips, tris, quads) where strips that would
+    take up more bytes than drawing their faces as separate primitives have
+    been moved to the separate lists.
+    The costs are estimates: each strip is priced on its own, starting from no
+    transform, normal or color, since the primitive drawn before it depends on
+    what gets chosen. So a choice can be off by a few bytes. """
+    blank = Vertex(None, None, None, None, None)
+    cost = lambda vertices: commands_cost(
+            vertex_commands(vertices, transform_ids, tex_size, blank)[0])
+
+    tris = tris[:]
+    quads = quads[:]
+    kept_strips = ([], [])
+    for p_type, strips, kept, sep in ((2, tri_strips, kept_strips[0], tris),
+            (3, quad_strips, kept_strips[1], quads)):
+        for strip in strips:
+            faces = split_strip(strip, p_type)
+            # The strip needs its own begin (5 bytes) and end (1 byte) commands
+            if cost(faces) < 6 + cost(strip):
+                sep += faces
+            else:
+                kept.append(strip)
 
-    header_bytestr = bytearray()
-    header_aligned = AlignedBytes(header_bytestr, 4)
-    bytestr += from_uint(1, 4)
-    bytestr += from_uint(0, 4) # pointer
-    header_ptr = BytesPtr(aligned, 4, header_aligned, 0, 4)
+    return kept_strips[0], kept_strips[1], tris, quads
+
+# Most transforms a single display list can restore
+MAX_TRANSFORMS = 32
 
-    # Compile the geometry info
+def get_faces(mesh, material, bones, group_names, scale_factor):
+    """ Returns [Face], the faces of the mesh that use the material """
     if any(len(face.vertices) > 4 for face in mesh.polygons):
         raise Exception("A face has too many (more than 4) vertices. " + \
                 "All faces should be triangles or quadrilaterals.")
@@ -200,13 +238,59 @@ def export_display_list(mesh, material, bones, group_names, scale_factor):
 
         else:
             counter += len(face.vertices)
-            
-    if len({v.group for v in vertices}) > 32:
-        raise Exception("You can have at most 32 bones. (This is probably not the limit, " +
-                "but exporting more than 32 bones is tricky and not supported right now.)")
+
+    return faces
+
+def partition_faces(faces, max_transforms):
+    """ Returns [[Face]], the faces split into clusters that each use at most
+    max_transforms transforms. Faces that use the same transforms end up
+    in the same cluster. """
+    get_groups = lambda f: tuple(sorted({v.group for v in f.vertices}))
+
+    clusters = [] # [({int}, [Face])]
+    for face in sorted(faces, key=get_groups):
+        groups = set(get_groups(face))
+        cluster = next((c for c in clusters if groups <= c[0]), None)
+
+        if cluster is None:
+            if clusters and len(clusters[-1][0] | groups) <= max_transforms:
+                cluster = clusters[-1]
+            else:
+                cluster = (set(), [])
+                clusters.append(cluster)
+
+        cluster[0].update(groups)
+        cluster[1].append(face)
+
+    return [c[1] for c in clusters]
+
+def sort_by_group(vertices, num_per_primitive):
+    """ Returns the vertices of separate primitives reordered so that
+    primitives using the same transform are next to each other """
+    primitives = [vertices[i : i + num_per_primitive] \
+            for i in range(0, len(vertices), num_per_primitive)]
+    return [v for p in sorted(primitives, key=lambda p: p[0].group) for v in p]
+
+def export_display_list(faces, tex_size, name, quantize=True):
+    """ Returns (bone_data, other_data, ptrs) where:
+    bone_data: AlignedBytes is the bytestring of the bone
+    name_data: [AlignedBytes] is a list of relevant detached bytestrings
+    ptrs: [BytesPtr] is a list of relevant pointers
+
+    The faces must use at most MAX_TRANSFORMS transforms.
+    If quantize is True, vertices that get encoded identically are merged.
+    """
+    bytestr = bytearray()
+    aligned = AlignedBytes(bytestr, 4)
+
+    header_bytestr = bytearray()
+    header_aligned = AlignedBytes(header_bytestr, 4)
+    bytestr += from_uint(1, 4)
+    bytestr += from_uint(0, 4) # pointer
+    header_ptr = BytesPtr(aligned, 4, header_aligned, 0, 4)
 
     # Transform ID list
-    transform_ids = list({v.group for v in vertices})
+    transform_ids = sorted({v.group for f in faces for v in f.vertices})
     header_bytestr += from_uint(len(transform_ids), 4)
     header_bytestr += from_uint(0, 4) # pointer
     transform_bytestr = AlignedBytes(from_uint_list(transform_ids, 1), 1)
@@ -216,11 +300,17 @@ def export_display_list(mesh, material, bones, group_names, scale_factor):
     dl_bytestr = bytearray()
     dl_aligned = AlignedBytes(dl_bytestr, 4)
 
-    geo = Geometry(vertices, faces)
-    tri_strips, quad_strips, tris, quads = geo.strip()
+    geo = Geometry([v for f in faces for v in f.vertices], faces,
+            tex_size=tex_size if quantize else None)
+    tri_strips, quad_strips, tris, quads = choose_primitives(*geo.strip(),
+            transform_ids, tex_size)
+
+    # Group primitives by transform to avoid matrix restores
+    tri_strips.sort(key=lambda s: s[0].group)
+    quad_strips.sort(key=lambda s: s[0].group)
+    tris = sort_by_group(tris, 3)
+    quads = sort_by_group(quads, 4)
 
-    tex_size = material.texture_slots[0].texture.image.size if material.texture_slots[0] \
-            else (32, 32)
     cmd_offset = 0
     prev_vertex = Vertex(None, None, None, None, None)
     for p_type, strips in ((2, tri_strips), (3, quad_strips)):
@@ -236,6 +326,11 @@ def export_display_list(mesh, material, bones, group_names, scale_factor):
     # If the last command is parameterless (which it is), then add some 0s.
     dl_bytestr += from_uint(0, 4)
 
+    num_tris = sum(len(f.vertices) - 2 for f in geo.faces)
+    if num_tris:
+        print(name, len(dl_bytestr), "bytes,",
+                "{:.2f}".format(len(dl_bytestr) / num_tris), "bytes per triangle")
+
     header_bytestr += from_uint(len(dl_bytestr), 4)
     header_bytestr += from_uint(0, 4) # pointer
     dl_ptr = BytesPtr(header_aligned, 0xc, dl_aligned, 0, 4)
@@ -243,6 +338,17 @@ def export_display_list(mesh, material, bones, group_names, scale_factor):
     return (aligned, [header_aligned, transform_bytestr, dl_aligned], \
             [header_ptr, transform_ptr, dl_ptr])
 
+def export_display_lists(mesh, material, bones, group_names, scale_factor, quantize=True):
+    """ Returns [(bone_data, other_data, ptrs)], the display lists that draw the
+    faces using the material. Faces get split into several display lists if
+    they use more than MAX_TRANSFORMS transforms in total. """
+    faces = get_faces(mesh, material, bones, group_names, scale_factor)
+    tex_size = material.texture_slots[0].texture.image.size if material.texture_slots[0] \
+            else (32, 32)
+
+    return [export_display_list(cluster, tex_size, material.name, quantize) \
+            for cluster in partition_faces(faces, MAX_TRANSFORMS) or [[]]]
+
 def export_texture(texture):
     """ Returns (tex_header, tex_name_data, tex_data, tex_ptrs,
             pal_header, pal_name_data, pal_data, pal_ptrs)
@@ -375,11 +481,127 @@ def export_material(material, ref_textures):
 
     return aligned, name_bytes, name_ptr
 
+# Per-frame limits of the DS's 3D hardware
+MAX_POLYGONS = 2048
+MAX_VERTICES = 6144
+TEXTURE_VRAM = 4 * 0x20000 # 4 banks of 128 KiB
+PALETTE_VRAM = 0x18000 # banks E, F and G
+
+def display_list_report(data_bytes):
+    """ Returns a dict with a histogram of the commands in the display list data
+    and the number of polygons and vertices it draws """
+    histogram = {}
+    num_polygons = 0
+    num_vertices = 0
+    p_type = None
+    prim_vertices = 0
+
+    def end_primitive():
+        if p_type is None:
+            return 0
+        return prim_vertices // 3 if p_type == 0 else \
+                prim_vertices // 4 if p_type == 1 else \
+                max(prim_vertices - 2, 0) if p_type == 2 else \
+                max(prim_vertices - 2, 0) // 2
+
+    for cmd, offset in gx_commands(data_bytes):
+        histogram["0x{:02x}".format(cmd)] = histogram.get("0x{:02x}".format(cmd), 0) + 1
+        if cmd == 0x40:
+            num_polygons += end_primitive()
+            p_type = to_uint(data_bytes, offset, 1) % 4
+            prim_vertices = 0
+        elif cmd == 0x41:
+            num_polygons += end_primitive()
+            p_type = None
+        elif 0x23 <= cmd <= 0x28:
+            prim_vertices += 1
+            num_vertices += 1
+    num_polygons += end_primitive()
+
+    return {"bytes": len(data_bytes), "commands": histogram,
+            "polygons": num_polygons, "vertices": num_vertices}
+
+def make_report(bytestr, sections):
+    """ Returns a report of how big each section of the BMD is and how much
+    of the DS's resources the model uses, as a dict that can be saved as JSON.
+    bytestr: bytes is the assembled BMD
+    sections: [(str, int)] are the names and offsets of the sections
+    """
+    sections = sorted(sections, key=lambda s: s[1])
+    ends = [offset for _, offset in sections[1:]] + [len(bytestr)]
+    report = {"bytes": len(bytestr),
+            "sections": [{"name": name, "offset": offset, "bytes": end - offset}
+                for (name, offset), end in zip(sections, ends)]}
+
+    # Textures and palettes
+    report["textures"] = []
+    for i in range(to_uint(bytestr, 0x14, 4)):
+        tex_offset = to_uint(bytestr, 0x18, 4) + 0x14 * i
+        type_ = to_uint(bytestr, tex_offset + 0x10, 4) >> 26 & 7
+        size = to_uint(bytestr, tex_offset + 0x8, 4)
+        pal_offset = to_uint(bytestr, 0x20, 4) + 0x10 * i
+        report["textures"].append({
+            "name": cstr_to_str(bytestr, to_uint(bytestr, tex_offset, 4)),
+            "format": Texture.NAMES.get(type_, hex(type_)),
+            "width": to_uint(bytestr, tex_offset + 0xc, 2),
+            "height": to_uint(bytestr, tex_offset + 0xe, 2),
+            # Compressed textures also have a block of palette indexes
+            "vram_bytes": size * 3 // 2 if type_ == Texture.COMPRESSED else size,
+            "palette_vram_bytes": to_uint(bytestr, pal_offset + 0x8, 4),
+        })
+
+    # Display lists
+    report["display_lists"] = []
+    for i in range(to_uint(bytestr, 0xc, 4)):
+        header_offset = to_uint(bytestr, to_uint(bytestr, 0x10, 4) + 8 * i + 4, 4)
+        data_bytes = get_n_bytes(bytestr, to_uint(bytestr, header_offset + 0xc, 4),
+                to_uint(bytestr, header_offset + 0x8, 4))
+        report["display_lists"].append(display_list_report(data_bytes))
+
+    def usage(used, limit):
+        return {"used": used, "limit": limit, "fraction": used / limit}
+
+    report["limits"] = {
+        "polygons": usage(sum(d["polygons"] for d in report["display_lists"]),
+            MAX_POLYGONS),
+        "vertices": usage(sum(d["vertices"] for d in report["display_lists"]),
+            MAX_VERTICES),
+        "texture_vram": usage(sum(t["vram_bytes"] for t in report["textures"]),
+            TEXTURE_VRAM),
+        "palette_vram": usage(sum(t["palette_vram_bytes"] for t in report["textures"]),
+            PALETTE_VRAM),
+    }
+
+    return report
+
+def print_report(report):
+    print("BMD size:", report["bytes"], "bytes")
+    for section in sorted(report["sections"], key=lambda s: -s["bytes"]):
+        print("  {:<20} {:>8} bytes ({:.1%})".format(section["name"], section["bytes"],
+            section["bytes"] / report["bytes"]))
+
+    for tex in report["textures"]:
+        print("  Texture {}: {} {}x{}, {} + {} bytes of VRAM".format(tex["name"],
+            tex["format"], tex["width"], tex["height"],
+            tex["vram_bytes"], tex["palette_vram_bytes"]))
+
+    for i, dl in enumerate(report["display_lists"]):
+        print("  Display list {}: {} bytes, {} polygons, {} vertices".format(i,
+            dl["bytes"], dl["polygons"], dl["vertices"]))
+
+    for name, usage in sorted(report["limits"].items()):
+        print("  {:<20} {:>8} / {} ({:.1%}){}".format(name, usage["used"], usage["limit"],
+            usage["fraction"], " OVER LIMIT" if usage["used"] > usage["limit"] else ""))
+
 def get_group_names(mesh):
     return [g.name for g in [obj.vertex_groups for obj in bpy.data.objects \
             if obj.data == mesh][0]]
 
-def save(context, filepath, *, sm256=False):
+def get_selection(context):
+    """ Returns (meshes, bones) where:
+    meshes: [bpy.types.Mesh] are the selected meshes, sorted by name
+    bones: [bpy.types.Bone] are the bones of the selected armature, if any
+    """
     meshes = sorted((obj.data for obj in context.selected_objects if obj.type == "MESH"),
             key=lambda mesh: mesh.name)
     rigs = [obj.data for obj in context.selected_objects if obj.type == "ARMATURE"]
@@ -389,12 +611,25 @@ def save(context, filepath, *, sm256=False):
             (not bones and len(meshes) > 8):
         raise Exception("Select either exactly 1 mesh and 1 armature or up to 8 meshes.")
 
-    bytestr_list = BytesWithPtrs()
+    return meshes, bones
 
-    all_verts = [(bones[get_group_names(m)[v.groups[0].group]].matrix_local.inverted() * v.co \
+def get_vertex_positions(meshes, bones):
+    """ Returns the positions of the vertices of the meshes, relative to their bones """
+    return [(bones[get_group_names(m)[v.groups[0].group]].matrix_local.inverted() * v.co \
                     if bones and len(v.groups) > 0 else v.co) \
                     for m in meshes for v in m.vertices]
 
+def export_model(context, *, sm256=False, quantize_vertices=True):
+    """ Returns (bytestr, sections) where:
+    bytestr: bytearray is the BMD of the selection
+    sections: [(str, int)] are the names and offsets of the BMD's sections
+    """
+    meshes, bones = get_selection(context)
+
+    bytestr_list = BytesWithPtrs()
+
+    all_verts = get_vertex_positions(meshes, bones)
+
     max_coord = max(abs(c) for v in all_verts for c in v)
     scale_factor = max(int(math.log2(max_coord)) - 2, 0)
     # Values really close to 8 can still round to 8, so account for that
@@ -410,11 +645,17 @@ def save(context, filepath, *, sm256=False):
     range_offset_y = (min_y + max_y) / 2
     range_ = max((v - Vector((0, range_offset_y, 0))).length for v in all_verts)
 
-    bone_data = [export_bone(b, bones, m.materials, m, meshes, get_group_names(m)) \
-            for m in meshes for b in (bones if bones else [None])]
     textures = []
-    displist_data = [export_display_list(m, mat, bones, get_group_names(m), scale_factor) 
-            for m in meshes for mat in m.materials]
+    displist_data = []
+    displist_materials = []
+    for i, (m, mat) in enumerate((m, mat) for m in meshes for mat in m.materials):
+        dls = export_display_lists(m, mat, bones, get_group_names(m), scale_factor,
+                quantize_vertices)
+        displist_materials += [i] * len(dls)
+        displist_data += dls
+    bone_data = [export_bone(b, bones, m.materials, m, meshes, get_group_names(m),
+                displist_materials) \
+            for m in meshes for b in (bones if bones else [None])]
     material_data = [export_material(mat, textures) \
             for m in meshes for mat in m.materials]
     texture_data = [export_texture(tex) for tex in textures]
@@ -499,7 +740,27 @@ def save(context, filepath, *, sm256=False):
     bytestr_list.ptrs += [v[2] for v in material_data]
 
     full_bytestr = bytestr_list.assemble()
+
+    markers = [("header", header_aligned), ("bones", bone_marker),
+            ("transform-bone map", tb_bytestr), ("display lists", displist_marker),
+            ("textures", texture_marker), ("palettes", palette_marker),
+            ("materials", material_marker), ("texture data", tex_data_marker)]
+    if texture_data:
+        markers.append(("palette data", texture_data[0][6]))
+
+    return full_bytestr, [(name, bytestr_list.positions[bytestr_list.bytestrs.index(marker)]) \
+            for name, marker in markers]
+
+def save(context, filepath, *, sm256=False, quantize_vertices=True, report=False):
+    full_bytestr, sections = export_model(context, sm256=sm256,
+            quantize_vertices=quantize_vertices)
     with open(filepath, "wb") as f:
         f.write(full_bytestr)
+
+    if report:
+        bmd_report = make_report(full_bytestr, sections)
+        with open(os.path.splitext(filepath)[0] + "_report.json", "w") as f:
+            json.dump(bmd_report, f, indent=4, sort_keys=True)
+        print_report(bmd_report)
         
     return {"FINISHED"}
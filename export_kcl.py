@@ -2,7 +2,8 @@ from .util import *
 from .kcl_util import *
 from math import log2
 
-def export_mesh(context, obj, scale=1.0, one_clps_index=False):
+def export_mesh(context, obj, scale=1.0, one_clps_index=False, use_processes=False,
+        share_suffixes=False):
     mesh = obj.data
     tri_mod = obj.modifiers.new("Triangulate", "TRIANGULATE")
     mesh = obj.to_mesh(context.scene, True, "RENDER")
@@ -30,9 +31,10 @@ def export_mesh(context, obj, scale=1.0, one_clps_index=False):
     tri_list = AlignedBytes(kcl_mesh.export(), 4)
     tri_ptr = BytesPtr(header_aligned, 0x8, tri_list, -0x10, 4)
 
-    octree = Octree.create(kcl_mesh, 15, 1)
+    # Starting the processes takes longer than building small octrees
+    octree = Octree.create(kcl_mesh, 15, 1, use_processes=use_processes and len(tris) > 4096)
     header += from_uint(0, 4) # pointer
-    octree_bytes = AlignedBytes(octree.export(), 4)
+    octree_bytes = AlignedBytes(octree.export(share_suffixes), 4)
     octree_ptr = BytesPtr(header_aligned, 0xc, octree_bytes, 0, 4)
 
     header += from_uint(327680, 4) # unknown
@@ -52,9 +54,11 @@ def export_mesh(context, obj, scale=1.0, one_clps_index=False):
     return bytestr_list.assemble()
 
 
-def save(context, filepath, *, scale=1.0, one_clps_index=False):
+def save(context, filepath, *, scale=1.0, one_clps_index=False, use_processes=True,
+        share_suffixes=False):
     obj = context.active_object
-    bytestr = export_mesh(context, obj, scale=scale, one_clps_index=one_clps_index)
+    bytestr = export_mesh(context, obj, scale=scale, one_clps_index=one_clps_index,
+            use_processes=use_processes, share_suffixes=share_suffixes)
     with open(filepath, "wb") as f:
         f.write(bytestr)
         
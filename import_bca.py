@@ -0,0 +1,117 @@
+import bpy
+import struct
+import numpy as np
+from pathlib import PurePath
+from .util import *
+from .bmd_reader import MappedFile
+from .export_bca import decompose
+
+def decode_anim(bytestr):
+    """ Returns (num_bones, num_frames, values) where values[bone][channel][frame] are the
+    encoded scale x, y, z, rotation x, y, z and translation x, y, z of each frame.
+    The layout is the one AnimDesc and AnimBone write. """
+    num_bones, num_frames = struct.unpack_from("<HH", bytestr, 0)
+    pools = [np.frombuffer(bytestr, dtype=dtype, offset=offset).astype(np.int64)
+            for dtype, offset in zip(["<i4", "<i2", "<i4"],
+                struct.unpack_from("<III", bytestr, 0x8))]
+    anim_addr = struct.unpack_from("<I", bytestr, 0x14)[0]
+
+    frames = np.arange(num_frames)
+    # Interpolation range
+    ir = (num_frames - 1) // 2 * 2 + 1
+    values = np.empty((num_bones, 9, num_frames), dtype=np.int64)
+    for bone in range(num_bones):
+        for channel in range(9):
+            interp, not_one, index = struct.unpack_from("<BBH", bytestr,
+                    anim_addr + 4 * (9 * bone + channel))
+            pool = pools[channel // 3]
+            if not not_one:
+                values[bone, channel] = pool[index]
+            elif not interp:
+                values[bone, channel] = pool[index + frames]
+            else:
+                # Odd frames within the interpolation range are halfway between their neighbors
+                last = len(pool) - index - 1
+                kept = pool[index + np.minimum(frames // 2 + (frames >= ir), last)]
+                after = pool[index + np.minimum(frames // 2 + 1, last)]
+                odd = (frames % 2 == 1) & (frames < ir)
+                values[bone, channel] = np.where(odd, (kept + after) // 2, kept)
+
+    return num_bones, num_frames, values
+
+def pose_matrices(values):
+    """ Returns an array of the pose matrix of each bone at each frame, indexed by frame
+    and bone, from the values returned by decode_anim """
+    scales = values[:, 0:3].transpose(2, 0, 1) / 4096
+    angles = values[:, 3:6].transpose(2, 0, 1) * (2 * np.pi / 65536)
+    translations = values[:, 6:9].transpose(2, 0, 1) / 4096
+
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    cx, cy, cz = cos[..., 0], cos[..., 1], cos[..., 2]
+    sx, sy, sz = sin[..., 0], sin[..., 1], sin[..., 2]
+    # XYZ Euler: rotate around X, then Y, then Z
+    rotations = np.stack([
+        np.stack([cy * cz, sx * sy * cz - cx * sz, cx * sy * cz + sx * sz], axis=-1),
+        np.stack([cy * sz, sx * sy * sz + cx * cz, cx * sy * sz - sx * cz], axis=-1),
+        np.stack([-sy, sx * cy, cx * cy], axis=-1)], axis=-2)
+
+    mtxs = np.zeros(scales.shape[:2] + (4, 4))
+    mtxs[..., 0:3, 0:3] = rotations * scales[..., None, :]
+    mtxs[..., 0:3, 3] = translations
+    mtxs[..., 3, 3] = 1
+    return mtxs
+
+def basis_matrices(obj, mtxs):
+    """ Returns the matrix_basis of each bone at each frame that gives the pose matrices """
+    bones = obj.pose.bones
+    parents = [bones.find(b.parent.name) if b.parent else -1 for b in bones]
+    # Rest matrix of each bone relative to its parent
+    rests = np.array([[list(row) for row in (b.parent.bone.matrix_local.inverted() *
+            b.bone.matrix_local if b.parent else b.bone.matrix_local)] for b in bones])
+
+    parent_mtxs = np.where(np.array(parents)[None, :, None, None] >= 0,
+            mtxs[:, parents], np.eye(4))
+    return np.linalg.inv(parent_mtxs @ rests) @ mtxs
+
+def add_fcurve(action, data_path, index, group, frames, vals):
+    """ Adds an F-curve with a keyframe at each frame, or just one if the value
+    doesn't change """
+    fcurve = action.fcurves.new(data_path, index, group)
+    if (vals == vals[0]).all():
+        frames = frames[:1]
+        vals = vals[:1]
+
+    fcurve.keyframe_points.add(len(frames))
+    fcurve.keyframe_points.foreach_set("co", np.stack([frames, vals], axis=-1)
+            .astype(np.float32).ravel())
+    fcurve.update()
+
+def load(context, filepath):
+    obj = context.active_object
+    if not obj or obj.type != "ARMATURE":
+        raise Exception("Select the armature to import the animation to.")
+
+    with MappedFile(filepath) as bca:
+        num_bones, num_frames, values = decode_anim(bca.bytestr)
+    if num_bones != len(obj.pose.bones):
+        raise Exception("The animation has {} bones, but the armature has {}.".format(
+            num_bones, len(obj.pose.bones)))
+
+    scales, rotations, translations = decompose(basis_matrices(obj, pose_matrices(values)))
+
+    action = bpy.data.actions.new(PurePath(filepath).stem)
+    obj.animation_data_create()
+    obj.animation_data.action = action
+
+    frames = np.arange(num_frames, dtype=np.float64) + context.scene.frame_start
+    for i, bone in enumerate(obj.pose.bones):
+        bone.rotation_mode = "XYZ"
+        for prop, vals in [("location", translations), ("rotation_euler", rotations),
+                ("scale", scales)]:
+            for index in range(3):
+                add_fcurve(action, 'pose.bones["{}"].{}'.format(bone.name, prop), index,
+                        bone.name, frames, vals[:, i, index])
+
+    context.scene.frame_end = context.scene.frame_start + num_frames - 1
+    return {"FINISHED"}
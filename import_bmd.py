@@ -1,8 +1,14 @@
 import bpy
+import hashlib
 import math
+import os
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import PurePath
 from mathutils import Euler, Matrix
 from .util import *
+from .bmd_reader import BmdFile, ParseCache
 
 def import_bone(bytestr, bone_bytes):
     """ Returns (bone, displist_material_map) """
@@ -34,243 +40,362 @@ def import_bone(bytestr, bone_bytes):
     return bone, {d: m for m, d in zip(mat_ids, displist_ids)}
     
 
-def import_bones(bytestr):
+def import_bones(bmd):
     """ Returns (skeleton, displist_material_map) """
     displist_material_map = {}
     bones = []
-    bone_offset = to_uint(bytestr, 8, 4)
 
-    for i in range(to_uint(bytestr, 4, 4)):
-        bone, dmm = import_bone(bytestr, get_n_bytes(bytestr, bone_offset + i * 0x40, 0x40))
+    for bone_bytes in bmd.table("bones"):
+        bone, dmm = import_bone(bmd.bytestr, bone_bytes)
         bones.append(bone)
         displist_material_map.update(dmm)
 
     return Skeleton(bones), displist_material_map
 
 
-def read_vertex(cmd, data_bytes, offset, p_type, group_id, tex_coords, normal, color, position,
-        material_id, ref_vertices, ref_faces):
-    """ Returns (offset, position), where:
-    offset: int is the new offset
-    position: Vector is the new previous position
-    """
-    new_position = None
-
-    if cmd == 0x23:
-        new_position = Vector(to_vec(data_bytes, offset, 2, 3, 12))
-    
-    elif cmd == 0x24:
-        new_position = Vector(to_vecb(data_bytes, offset, 10, 3, 6))
-
-    else:
-        new_position = position.copy()
-
-        if cmd == 0x25:
-            new_position.x = to_fix(data_bytes, offset + 0, 2, 12)
-            new_position.y = to_fix(data_bytes, offset + 2, 2, 12)
+# Parameter unpackers
+unpack_uint32 = struct.Struct("<I").unpack_from
+unpack_int16x2 = struct.Struct("<hh").unpack_from
+unpack_int16x3 = struct.Struct("<hhh").unpack_from
+
+def sign_int10(integer):
+    return (integer & 0x3ff ^ 0x200) - 0x200
+
+class DisplayListDecoder:
+    """ Decodes display lists into an ImportedGeometry by walking the data
+    with a table of command handlers indexed by command byte. """
+
+    def __init__(self, geo):
+        self.geo = geo
+        self.handlers = [None] * 256
+        self.param_sizes = [0] * 256
+        for cmd, size in GX_PARAM_SIZES.items():
+            self.handlers[cmd] = self.skip
+            self.param_sizes[cmd] = size
+
+        self.handlers[0x40] = self.begin
+        self.handlers[0x14] = self.restore_matrix
+        self.handlers[0x20] = self.color
+        self.handlers[0x21] = self.normal
+        self.handlers[0x22] = self.tex_coords
+        for cmd in range(0x23, 0x29):
+            self.handlers[cmd] = self.vertex
+
+    def decode(self, data_bytes, group_ids, material_id):
+        """ Adds the faces of the display list to the geometry.
+        data_bytes: memoryview is the display list data
+        group_ids: [int] are the groups the transform IDs of the display list refer to
+        """
+        self.group_ids = group_ids
+        self.material_id = material_id
+        self.p_type = None
+        self.prim_start = self.geo.num_vertices()
+        self.cur_color = None
+        self.cur_normal = None
+        self.cur_tex_coords = None
+        self.position = (0, 0, 0)
+        self.group_id = group_ids[0] if group_ids else 0
+
+        handlers = self.handlers
+        param_sizes = self.param_sizes
+        offset = 0
+        while offset < len(data_bytes):
+            cmds = data_bytes[offset : offset + 4]
+            offset += 4
+
+            for cmd in cmds:
+                handler = handlers[cmd]
+                if handler is None:
+                    raise Exception("Unknown GX command: " + hex(cmd) +
+                            " at offset: " + hex(offset))
+                handler(cmd, data_bytes, offset)
+                offset += param_sizes[cmd]
+
+    def skip(self, cmd, data_bytes, offset):
+        pass
+
+    def begin(self, cmd, data_bytes, offset): # Begin vertex list
+        self.p_type = data_bytes[offset] % 4
+        self.prim_start = self.geo.num_vertices()
+
+    def restore_matrix(self, cmd, data_bytes, offset):
+        self.group_id = self.group_ids[unpack_uint32(data_bytes, offset)[0] % 32]
+
+    def color(self, cmd, data_bytes, offset):
+        self.cur_color = unpack_uint32(data_bytes, offset)[0] & 0x7fff
+
+    def normal(self, cmd, data_bytes, offset):
+        n = unpack_uint32(data_bytes, offset)[0]
+        self.cur_normal = (sign_int10(n), sign_int10(n >> 10), sign_int10(n >> 20))
+
+    def tex_coords(self, cmd, data_bytes, offset):
+        self.cur_tex_coords = unpack_int16x2(data_bytes, offset)
+
+    def vertex(self, cmd, data_bytes, offset):
+        x, y, z = self.position
+        if cmd == 0x23:
+            x, y, z = unpack_int16x3(data_bytes, offset)
+        elif cmd == 0x24:
+            p = unpack_uint32(data_bytes, offset)[0]
+            x, y, z = (sign_int10(p) << 6, sign_int10(p >> 10) << 6, sign_int10(p >> 20) << 6)
+        elif cmd == 0x25:
+            x, y = unpack_int16x2(data_bytes, offset)
         elif cmd == 0x26:
-            new_position.x = to_fix(data_bytes, offset + 0, 2, 12)
-            new_position.z = to_fix(data_bytes, offset + 2, 2, 12)
+            x, z = unpack_int16x2(data_bytes, offset)
         elif cmd == 0x27:
-            new_position.y = to_fix(data_bytes, offset + 0, 2, 12)
-            new_position.z = to_fix(data_bytes, offset + 2, 2, 12)
-
-        elif cmd == 0x28:
-            new_position += Vector(to_vecb(data_bytes, offset, 10, 3, 12))
-    
-    ref_vertices.append(Vertex(new_position, 
-        normal.copy() if normal else None,
-        tex_coords.copy() if tex_coords else None,
-        color.copy() if color else None,
-        group_id))
-
-    # Face addition
-    if p_type in (0, 1) and len(ref_vertices) % (p_type + 3) == 0:
-        ref_faces.append(Face(ref_vertices[-(p_type + 3):], material_id))
-
-    elif p_type == 2 and len(ref_vertices) >= 3:
-        ref_faces.append(Face([ref_vertices[i] for i in
-            ((-2, -3, -1) if len(ref_vertices) % 2 == 0 else (-3, -2, -1))], material_id))
-
-    elif p_type == 3 and len(ref_vertices) % 2 == 0 and len(ref_vertices) >= 4:
-        ref_faces.append(Face([ref_vertices[i] for i in (-4, -3, -1, -2)], material_id))
-
-    offset += 8 if cmd == 0x23 else 4
-    return offset, new_position
-
-
-def import_display_list(bytestr, displist_bytes, skeleton, material_id):
-    """ Returns (vertices, faces) of the whole display list. """
-
-    header_bytes = get_n_bytes(bytestr, to_uint(displist_bytes, 4, 4), 0x10)
-    transform_ids = to_uint_list(bytestr, to_uint(header_bytes, 4, 4), 1,
-            to_uint(header_bytes, 0, 4))
-    data_bytes = get_n_bytes(bytestr, to_uint(header_bytes, 0xc, 4),
-            to_uint(header_bytes, 8, 4))
-
-    p_type = None
-    vertices = None
-    faces = None
-    offset = 0
-    tex_coords = None
-    normal = None
-    color = None
-    position = None
-    group_id = None
-    accum_vertices = []
-    accum_faces = []
-
-    # for i in range(0, 0x100, 16):
-    #     print(["{:2x}".format(byte) for byte in get_n_bytes(data_bytes, i, 16)])
-    
-    while offset < len(data_bytes):
-        cmds = to_uint_list(data_bytes, offset, 1, 4)
-        offset += 4
-
-        for cmd in cmds:
-            if cmd == 0x40: # Begin vertex list
-                p_type = to_uint(data_bytes, offset, 1) % 4
-                if vertices is not None:
-                    accum_vertices += vertices
-                    accum_faces += faces
-                vertices = []
-                faces = []
-                offset += 4
-
-            elif cmd == 0x14: # Matrix restore
-                transform_id = to_uint(data_bytes, offset, 4) % 32
-                group_id = to_uint(bytestr, 
-                        to_uint(bytestr, 0x2c, 4) + transform_ids[transform_id] * 2, 2)
-                offset += 4
-
-            elif cmd == 0x20: # Color
-                color = uint16_to_color(to_uint(data_bytes, offset, 2), 1)
-                offset += 4
-
-            elif cmd == 0x21: # Normal
-                normal = Vector(to_vecb(data_bytes, offset, 10, 3, 9))
-                offset += 4
-
-            elif cmd == 0x22: # Texture coordinates
-                tex_coords = Vector(to_vec(data_bytes, offset, 2, 2, 4))
-                offset += 4
-
-            elif cmd in (0x23, 0x24, 0x25, 0x26, 0x27, 0x28):
-                offset, position = read_vertex(cmd, data_bytes, offset, p_type, group_id,
-                        tex_coords, normal, color, position, material_id, vertices, faces)
-                
-            elif cmd in (0x34,):
-                offset += 128
-
-            elif cmd in (0x16, 0x18):
-                offset += 64
-
-            elif cmd in (0x17, 0x19):
-                offset += 48
-
-            elif cmd in (0x1a,):
-                offset += 36
-            
-            elif cmd in (0x1b, 0x1c, 0x70):
-                offset += 12
-
-            elif cmd in (0x71,):
-                offset += 8
-
-            elif cmd in (0x10, 0x12, 0x13, 0x29, 0x2a, 0x2b,
-                    0x30, 0x31, 0x32, 0x33, 0x50, 0x60, 0x72):
-                offset += 4
-
-            elif cmd in (0x00, 0x11, 0x15, 0x41):
-                pass
-
-            else:
-                raise Exception("Unknown GX command: " + hex(cmd) +
-                        " at offset: " + hex(offset))
-
-    if vertices is not None:
-        accum_vertices += vertices
-        accum_faces += faces
-
-    return accum_vertices, accum_faces
+            y, z = unpack_int16x2(data_bytes, offset)
+        else:
+            p = unpack_uint32(data_bytes, offset)[0]
+            x, y, z = (x + sign_int10(p), y + sign_int10(p >> 10), z + sign_int10(p >> 20))
+        self.position = (x, y, z)
+
+        geo = self.geo
+        geo.positions.extend(self.position)
+        geo.normals.extend(self.cur_normal or (0, 0, 0))
+        geo.has_normal.append(self.cur_normal is not None)
+        geo.tex_coords.extend(self.cur_tex_coords or (0, 0))
+        geo.has_tex_coords.append(self.cur_tex_coords is not None)
+        geo.colors.append(self.cur_color or 0)
+        geo.has_color.append(self.cur_color is not None)
+        geo.groups.append(self.group_id)
+
+        # Face addition
+        end = geo.num_vertices()
+        n = end - self.prim_start
+        p_type = self.p_type
+        loops = None
+        if p_type in (0, 1) and n % (p_type + 3) == 0:
+            loops = range(end - (p_type + 3), end)
+
+        elif p_type == 2 and n >= 3:
+            loops = (end - 2, end - 3, end - 1) if n % 2 == 0 else (end - 3, end - 2, end - 1)
+
+        elif p_type == 3 and n % 2 == 0 and n >= 4:
+            loops = (end - 4, end - 3, end - 1, end - 2)
+
+        if loops is not None:
+            geo.loops.extend(loops)
+            geo.face_sizes.append(len(loops))
+            geo.material_ids.append(self.material_id)
+
+
+def import_display_list(bytestr, displist_bytes, decoder, material_id):
+    """ Adds the geometry of the display list to the decoder's geometry. """
+
+    header_offset = to_uint(displist_bytes, 4, 4)
+    transform_ids = to_uint_list(bytestr, to_uint(bytestr, header_offset + 4, 4), 1,
+            to_uint(bytestr, header_offset, 4))
+    group_ids = [to_uint(bytestr, to_uint(bytestr, 0x2c, 4) + t * 2, 2)
+            for t in transform_ids]
+    data_offset = to_uint(bytestr, header_offset + 0xc, 4)
+    data_bytes = memoryview(bytestr)[data_offset :
+            data_offset + to_uint(bytestr, header_offset + 8, 4)]
+
+    decoder.decode(data_bytes, group_ids, material_id)
                 
 
-def import_display_lists(bytestr, skeleton, displist_material_map):
+def import_display_lists(bmd, displist_material_map):
     """ Returns the geometry. """
 
-    displist_offset = to_uint(bytestr, 0x10, 4)
-    vertices = []
-    faces = []
+    decoder = DisplayListDecoder(ImportedGeometry())
 
-    for i in range(to_uint(bytestr, 0xc, 4)):
+    for i, displist_bytes in enumerate(bmd.table("display_lists")):
         if i in displist_material_map:
-            v, f = import_display_list(bytestr, 
-                    get_n_bytes(bytestr, displist_offset + i * 8, 8),
-                    skeleton, displist_material_map[i])
-            vertices += v
-            faces += f
-
-    return Geometry(vertices, faces, False)
-
-def import_texture(bytestr, texture_id, palette_id, material, tex_cache):
+            import_display_list(bmd.bytestr, displist_bytes,
+                    decoder, displist_material_map[i])
+
+    return decoder.geo
+
+
+class ParsedBmd:
+    def __init__(self, bmd):
+        """
+        The parts of a BMD that take a while to read and don't depend on Blender data,
+        so they can be reused when an unchanged file is imported again.
+        geometries: {int: ImportedGeometry} maps bone index to the bone's geometry
+        texels: {str: array} maps texture_key to decoded texels
+        """
+        self.scale_factor = bmd.scale_factor
+        self.skeleton, self.displist_material_map = import_bones(bmd)
+        self.geometries = {}
+        self.texels = {}
+
+    def get_geometry(self, bmd, bone):
+        index = self.skeleton.bones.index(bone)
+        if index not in self.geometries:
+            self.geometries[index] = import_display_lists(bmd, {d: m for d, m in
+                self.displist_material_map.items() if d in bone.displist_ids})
+        return self.geometries[index]
+
+parse_cache = ParseCache(8)
+
+class TextureDecodeJob:
+    """ Decodes textures in worker threads and fills in their images on the main
+    thread from a scene update handler, so the model can be used right away. """
+
+    def __init__(self):
+        self.pending = {} # maps Texture to ([(material, blend_type, alpha)], texels, key)
+        self.futures = {} # maps Texture to Future
+
+    def add(self, tex, texels, key):
+        """ Has the texture decoded, storing the texels in texels[key] once it's done """
+        self.pending[tex] = ([], texels, key)
+
+    def add_material(self, tex, material, blend_type, alpha):
+        """ Has the material's transparency updated once the texture is decoded """
+        self.pending[tex][0].append((material, blend_type, alpha))
+
+    def fill(self, tex, rgba5555):
+        materials, texels, key = self.pending.pop(tex)
+        texels[key] = rgba5555
+        tex.set_pixels(rgba5555)
+        for material, blend_type, alpha in materials:
+            update_transparency(material, tex, blend_type, alpha)
+
+    def by_key(self):
+        """ Returns {key: [Texture]}, the pending textures grouped by texture_key.
+        Textures with the same key only need to be decoded once. """
+        by_key = {}
+        for tex, (_, _, key) in self.pending.items():
+            by_key.setdefault(key, []).append(tex)
+        return by_key
+
+    def start(self):
+        if self.pending:
+            self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            for texs in self.by_key().values():
+                future = self.executor.submit(texs[0].decode)
+                self.futures.update((tex, future) for tex in texs)
+            bpy.app.handlers.scene_update_post.append(self.poll)
+
+    def poll(self, scene):
+        for tex, future in list(self.futures.items()):
+            if future.done():
+                del self.futures[tex]
+                self.fill(tex, future.result())
+
+        if not self.futures:
+            bpy.app.handlers.scene_update_post.remove(self.poll)
+            self.executor.shutdown(wait=False)
+
+    def finish(self, pool, decode):
+        """ Decodes the textures with pool.starmap(decode, ...) and fills them in,
+        waiting until they're done. pool can be None to decode them here. """
+        groups = list(self.by_key().values())
+        args = [texs[0].decode_args() for texs in groups]
+        results = pool.starmap(decode, args) if pool else [decode(*a) for a in args]
+        for texs, rgba5555 in zip(groups, results):
+            for tex in texs:
+                self.fill(tex, rgba5555)
+
+
+def texture_key(tex_data, pal_data, tex_bytes):
+    """ Returns a key that's the same for textures with the same contents,
+    even if they're in different files or have different names """
+    key = hashlib.sha1(tex_bytes[8:0x14])
+    key.update(tex_data)
+    if pal_data is not None:
+        key.update(pal_data)
+    return key.hexdigest()
+
+
+def import_texture(bmd, texture_id, palette_id, tex_cache, texels, job=None, repeat=0):
+    """ tex_cache maps (texture_key, repeat) to texture, and texels maps texture_key to
+    already decoded texels. If job is given, the texture is decoded by it later.
+    repeat is the repeat and flip bits of the material's texture parameters
+    (tex_param >> 16 & 0xf). They're settings of the Blender texture, so materials
+    that wrap the same texels differently get separate textures. """
     if texture_id < 0:
         return
 
-    tex_bytes = get_n_bytes(bytestr, to_uint(bytestr, 0x18, 4) + 0x14 * texture_id, 0x14)
-    pal_bytes = get_n_bytes(bytestr, to_uint(bytestr, 0x20, 4) + 0x10 * palette_id, 0x10) \
-            if palette_id >= 0 else None
+    bytestr = bmd.bytestr
+    tex_bytes = bmd.table("textures")[texture_id]
+    pal_bytes = bmd.table("palettes")[palette_id] if palette_id >= 0 else None
 
-    name = cstr_to_str(bytestr, to_uint(tex_bytes, 0, 4))
-    pal_name = cstr_to_str(bytestr, to_uint(pal_bytes, 0, 4)) if palette_id >= 0 else None
+    size = to_uint(tex_bytes, 0x8, 4)
+    type_ = to_uint(tex_bytes, 0x10, 4) >> 26 & 7
+    if type_ == Texture.COMPRESSED:
+        size = size * 3 // 2
+
+    tex_data = get_n_bytes(bytestr, to_uint(tex_bytes, 4, 4), size)
+    pal_data = get_n_bytes(bytestr, to_uint(pal_bytes, 4, 4), to_uint(pal_bytes, 8, 4)) \
+            if palette_id >= 0 else None
+    key = texture_key(tex_data, pal_data, tex_bytes)
 
     tex = None
-    if (name, pal_name) in tex_cache:
-        tex = tex_cache[(name, pal_name)]
+    if (key, repeat) in tex_cache:
+        tex = tex_cache[(key, repeat)]
 
     else:
-        size = to_uint(tex_bytes, 0x8, 4)
+        name = cstr_to_str(bytestr, to_uint(tex_bytes, 0, 4))
         width = to_uint(tex_bytes, 0xc, 2)
         height = to_uint(tex_bytes, 0xe, 2)
 
-        tex_param = to_uint(tex_bytes, 0x10, 4)
-        type_ = tex_param >> 26 & 7
-        transparency = tex_param >> 29 & 1
-        if type_ == Texture.COMPRESSED:
-            size = size * 3 // 2
-
-        tex_data = get_n_bytes(bytestr, to_uint(tex_bytes, 4, 4), size)
-        pal_data = get_n_bytes(bytestr, to_uint(pal_bytes, 4, 4), to_uint(pal_bytes, 8, 4)) \
-                if palette_id >= 0 else None
-
-        tex = Texture.from_bytestr(tex_data, pal_data, name, width, height, type_, transparency)
-        tex_cache[(name, pal_name)] = tex
+        transparency = to_uint(tex_bytes, 0x10, 4) >> 29 & 1
+
+        # Copied, since the texture may outlive the mapping of the file
+        tex = Texture.from_bytestr(bytes(tex_data),
+                bytes(pal_data) if pal_data is not None else None,
+                name, width, height, type_, transparency, False)
+        tex.key = key
+        tex_cache[(key, repeat)] = tex
+
+        tex.texture.extension = "REPEAT" if repeat & 3 else "EXTEND"
+        if (repeat & 3) in (1, 2):
+            # Only one axis repeats. The exporter reads these.
+            tex.texture["Extend X"] = int(not repeat & 1)
+            tex.texture["Extend Y"] = int(not repeat & 2)
+        tex.texture.use_mirror_x = bool(repeat >> 2 & 1)
+        tex.texture.use_mirror_y = bool(repeat >> 3 & 1)
+
+        if key in texels:
+            tex.set_pixels(texels[key])
+        elif job:
+            job.add(tex, texels, key)
+        else:
+            texels[key] = tex.decode()
+            tex.set_pixels(texels[key])
+
+    return tex
+
+
+def update_transparency(material, texture, blend_type, alpha):
+    """ Makes the material transparent if it should be. A texture that hasn't been
+    decoded yet counts as opaque. """
+    if (texture and texture.uses_alpha and blend_type != 1) or alpha != 31:
+        if texture:
+            material.texture_slots[0].use_map_alpha = True
+        material.use_transparency = True
+        material.alpha = alpha / 31
 
-    slot = material.texture_slots.add()
-    slot.texture = tex.texture
-    return tex.texture
 
+def import_material(bmd, material_bytes, material_id, mesh, geo, tex_cache, texels,
+        mat_cache=None, job=None):
+    """ If mat_cache is given, it maps material contents to materials,
+    and materials with the same contents are shared. """
+    name = cstr_to_str(bmd.bytestr, to_uint(material_bytes, 0, 4))
+    tex_param = to_uint(material_bytes, 0x20, 4)
+    texture = import_texture(bmd, to_int(material_bytes, 4, 4),
+            to_int(material_bytes, 8, 4), tex_cache, texels, job, tex_param >> 16 & 0xf)
+    tex = texture.texture if texture else None
+
+    key = (name, texture.key if texture else None, bytes(material_bytes[0x20:0x30]),
+            geo.has_normals(material_id))
+    if mat_cache is not None and key in mat_cache:
+        mesh.materials.append(mat_cache[key])
+        return
 
-def import_material(bytestr, material_bytes, material_id, mesh, geo, tex_cache):
-    material = bpy.data.materials.new(cstr_to_str(bytestr, to_uint(material_bytes, 0, 4)))
+    material = bpy.data.materials.new(name)
     mesh.materials.append(material)
-    tex = import_texture(bytestr, to_int(material_bytes, 4, 4), to_int(material_bytes, 8, 4),
-            material, tex_cache)
-
-    transparency = any(i % 4 == 3 and v < 1 for i, v in enumerate(tex.image.pixels)) \
-            if tex else False
-
-    # Texture parameters
+    if mat_cache is not None:
+        mat_cache[key] = material
     if tex:
-        tex_param = to_uint(material_bytes, 0x20, 4)
-        if (tex_param >> 16 & 3) == 0:
-            tex.extension = "EXTEND"
-        if tex_param >> 18 & 1:
-            tex.use_mirror_x = True
-        if tex_param >> 19 & 1:
-            tex.use_mirror_y = True
+        slot = material.texture_slots.add()
+        slot.texture = tex
 
-        if (tex_param >> 30 & 3) == 2:
-            material["Environment Map"] = 1
+    # Texture parameters. Repeating and flipping are set by import_texture.
+    if tex and (tex_param >> 30 & 3) == 2:
+        material["Environment Map"] = 1
 
     # Polygon parameters
     poly_param = to_uint(material_bytes, 0x24, 4)
@@ -282,11 +407,9 @@ def import_material(bytestr, material_bytes, material_id, mesh, geo, tex_cache):
         material["Depth Equal"] = 1
 
     alpha = poly_param >> 16 & 0x1f
-    if (transparency and blend_type != 1) or alpha != 31:
-        if tex:
-            material.texture_slots[0].use_map_alpha = True
-        material.use_transparency = True
-        material.alpha = alpha / 31
+    update_transparency(material, texture, blend_type, alpha)
+    if texture and texture.uses_alpha is None:
+        job.add_material(texture, material, blend_type, alpha)
 
     material["Polygon ID"] = poly_param >> 24 & 0x3f
 
@@ -298,8 +421,7 @@ def import_material(bytestr, material_bytes, material_id, mesh, geo, tex_cache):
     material.diffuse_color = diffuse
     material.diffuse_intensity = 1
     material.ambient = ambient
-    material.use_vertex_color_paint = all(v.normal is None
-            for f in geo.faces for v in f.vertices if f.material_id == material_id)
+    material.use_vertex_color_paint = not geo.has_normals(material_id)
     material.use_shadeless = material.use_vertex_color_paint
     
     spec_emit = to_uint(material_bytes, 0x2c, 4)
@@ -310,51 +432,87 @@ def import_material(bytestr, material_bytes, material_id, mesh, geo, tex_cache):
     material.emit = emission
 
 
-def import_materials(bytestr, mesh, geo, material_ids, tex_cache):
-    material_offset = to_uint(bytestr, 0x28, 4)
-
-    for i in range(to_uint(bytestr, 0x24, 4)):
+def import_materials(bmd, mesh, geo, material_ids, tex_cache, texels, mat_cache=None,
+        job=None):
+    for i, material_bytes in enumerate(bmd.table("materials")):
         if i in material_ids:
-            import_material(bytestr, get_n_bytes(bytestr, material_offset + i * 0x30, 0x30),
-                    i, mesh, geo, tex_cache)
+            import_material(bmd, material_bytes, i, mesh, geo, tex_cache, texels,
+                    mat_cache, job)
 
-    counter = 0
     material_table = {m: i for i, m in enumerate(sorted(material_ids))}
-    for face, poly in zip(geo.faces, mesh.polygons):
-        poly.material_index = material_table[face.material_id]
-
-        # UV downscaling
-        material = mesh.materials[material_table[face.material_id]]
-        if material.texture_slots[0]:
-            size = material.texture_slots[0].texture.image.size
-            for i in range(counter, counter + len(face.vertices)):
-                for j in range(2):
-                    mesh.uv_layers[0].data[i].uv[j] /= size[j]
-
-        counter += len(face.vertices)
-
-
-def load_ret(context, filepath):
-    bytestr = None
-    with open(filepath, "rb") as f:
-        bytestr = f.read()
-
-    scale = 2 ** to_uint(bytestr, 0, 4)
-    skeleton, displist_material_map = import_bones(bytestr)
-
-    bone = skeleton.bones[0]
-    tex_cache = {} # maps (tex_name, pal_name) to texture
-    objs = []
-    while bone:
-        geo = import_display_lists(bytestr, skeleton, 
-                {d: m for d, m in displist_material_map.items() if d in bone.displist_ids})
-        obj = geo.create_mesh(context, PurePath(filepath).stem, skeleton, scale)
-        import_materials(bytestr, obj.data, geo, bone.material_ids, tex_cache)
-        bone = bone.sibling
-        objs.append(obj)
+    face_materials = np.array([material_table[m] for m in geo.material_ids], dtype=np.int32)
+    mesh.polygons.foreach_set("material_index", face_materials.astype(np.int16))
+
+    # UVs, downscaled by the size of each material's texture
+    if any(geo.has_tex_coords):
+        tex_sizes = np.array([m.texture_slots[0].texture.image.size[:] \
+                if m.texture_slots[0] else (1, 1) for m in mesh.materials],
+                dtype=np.float64).reshape(-1, 2)
+        loop_sizes = np.repeat(tex_sizes[face_materials],
+                np.asarray(geo.face_sizes, dtype=np.int32), axis=0)
+
+        mesh.uv_textures.new("UVMap")
+        mesh.uv_layers[0].data.foreach_set("uv", geo.loop_uvs(loop_sizes))
 
+
+def load_ret(context, filepath, background_textures=False, tex_cache=None,
+        mat_cache=None, job=None):
+    """
+    If background_textures is True, textures are decoded in the background
+    and show up once they're ready.
+    tex_cache and mat_cache can be shared between calls so that files share
+    textures and materials with the same contents.
+    If job is given, textures are left for it to decode, and the caller finishes it.
+    """
+    if tex_cache is None:
+        tex_cache = {} # maps (texture_key, repeat) to texture
+    own_job = None
+    if job is None and background_textures:
+        job = own_job = TextureDecodeJob()
+
+    with BmdFile(filepath) as bmd:
+        parsed = parse_cache.get(filepath, lambda: ParsedBmd(bmd))
+
+        scale = 2 ** parsed.scale_factor
+        skeleton = parsed.skeleton
+
+        bone = skeleton.bones[0]
+        objs = []
+        while bone:
+            geo = parsed.get_geometry(bmd, bone)
+            obj = geo.create_mesh(context, PurePath(filepath).stem, skeleton, scale)
+            import_materials(bmd, obj.data, geo, bone.material_ids, tex_cache,
+                    parsed.texels, mat_cache, job)
+            bone = bone.sibling
+            objs.append(obj)
+
+    if own_job:
+        own_job.start()
     return objs
 
-def load(context, filepath):
-    load_ret(context, filepath)
+def load(context, filepath, *, background_textures=False):
+    load_ret(context, filepath, background_textures)
+    return {"FINISHED"}
+
+def load_batch(context, filepaths, *, use_processes=True):
+    """ Imports the files, sharing textures and materials with the same contents
+    between them. The textures are decoded at the end, in parallel processes
+    if use_processes is True. """
+    tex_cache = {}
+    mat_cache = {}
+    job = TextureDecodeJob()
+    for filepath in filepaths:
+        load_ret(context, filepath, tex_cache=tex_cache, mat_cache=mat_cache, job=job)
+
+    pool, decode = texture_decoding_pool() if use_processes and len(job.pending) > 1 \
+            else (None, decode_rgba5555)
+    try:
+        job.finish(pool, decode)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    print("Imported {} files with {} textures and {} materials".format(
+        len(filepaths), len(tex_cache), len(mat_cache)))
     return {"FINISHED"}
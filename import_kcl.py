@@ -1,10 +1,8 @@
 from .kcl_util import *
+from .bmd_reader import MappedFile
 
 def load(context, filepath):
-    bytestr = None
-    with open(filepath, "rb") as f:
-        bytestr = f.read()
-
-    octree = Octree.import_(bytestr)
+    with MappedFile(filepath) as kcl:
+        octree = Octree.import_(kcl.bytestr)
 
     return {"FINISHED"}
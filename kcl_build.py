@@ -0,0 +1,143 @@
+import multiprocessing
+import numpy as np
+
+# Doesn't import bpy, so octrees can be built in processes running Blender's Python.
+#
+# A node is a list of the indexes of the triangles that intersect its cube if it's a leaf,
+# or a tuple of its 8 children in k, j, i order if it's a branch.
+
+# Base of each child relative to the base of its parent, in units of the child's width
+CHILD_OFFSETS = np.array([(i, j, k) for k in range(2) for j in range(2) for i in range(2)],
+        dtype=np.float64)
+
+def triangles_intersect_box(vertices, normals, center, half_width):
+    """
+    Returns a boolean array telling which of the triangles intersect the axis-aligned
+    cube given by the center and half width. vertices[t] are the 3 vertices and normals[t]
+    the normal of triangle t. This is KclTriangle.intersects_box for all the triangles at once.
+    """
+    vs = vertices - np.asarray(center)
+
+    # Test for separation along the axes normal to the faces of the cube
+    mask = (vs.max(axis=1) >= -half_width).all(axis=1) & \
+            (vs.min(axis=1) <= half_width).all(axis=1)
+
+    # The other tests are only needed for the triangles that are left
+    left = np.flatnonzero(mask)
+    vs = vs[left]
+    n = normals[left]
+
+    # Test for separation along the axis normal to the face of the triangle
+    d = (n * vs[:, 0]).sum(axis=1)
+    r = half_width * np.abs(n).sum(axis=1)
+    hit = (d >= -r) & (d <= r)
+
+    # Test for separation along the axes parallel to the cross products of the
+    # edges of the triangle and the edges of the cube. edges[:, i] goes from vertex i
+    # to vertex i + 1, and axes[:, i, j] is its cross product with the unit vector along axis j.
+    edges = vs[:, [1, 2, 0]] - vs
+    ex, ey, ez = edges[..., 0], edges[..., 1], edges[..., 2]
+    zero = np.zeros_like(ex)
+    axes = np.stack([np.stack([zero, ez, -ey], axis=-1),
+                     np.stack([-ez, zero, ex], axis=-1),
+                     np.stack([ey, -ex, zero], axis=-1)], axis=2)
+    # Projections of the first vertex of each edge and the vertex opposite it
+    p = (axes * vs[:, :, None]).sum(axis=-1)
+    q = (axes * vs[:, [2, 0, 1], None]).sum(axis=-1)
+    r = half_width * np.abs(axes).sum(axis=-1)
+    hit &= ((np.maximum(p, q) >= -r) & (np.minimum(p, q) <= r)).all(axis=(1, 2))
+
+    mask[left] = hit
+    return mask
+
+
+def build_node(vertices, normals, base, width, indexes, max_triangles, min_width):
+    """
+    Returns the node whose cube has the given base and width. indexes is an array of the
+    indexes of the triangles that might intersect it. The node is a leaf if its cube
+    intersects at most max_triangles of them, or if splitting it would make the width
+    of the cube less than min_width.
+    """
+    base = np.asarray(base, dtype=np.float64)
+    indexes = indexes[triangles_intersect_box(vertices[indexes], normals[indexes],
+            base + width / 2, width / 2)]
+    if len(indexes) <= max_triangles or width < 2 * min_width:
+        return indexes.tolist()
+
+    return tuple(build_node(vertices, normals, base + offset * (width / 2), width / 2,
+            indexes, max_triangles, min_width) for offset in CHILD_OFFSETS)
+
+# The mesh of the process, set by init_worker
+worker_mesh = None
+
+def init_worker(raw_vertices, raw_normals, max_triangles, min_width):
+    """ Pool initializer. The arrays are multiprocessing.RawArrays of doubles, so the
+    triangles are shared with the process that started the pool instead of copied. """
+    global worker_mesh
+    worker_mesh = (np.frombuffer(raw_vertices).reshape(-1, 3, 3),
+            np.frombuffer(raw_normals).reshape(-1, 3), max_triangles, min_width)
+
+def build_task(base, width, indexes):
+    """ Returns build_node for the mesh of the process. indexes can be None for all
+    the triangles, which saves sending them. """
+    vertices, normals, max_triangles, min_width = worker_mesh
+    if indexes is None:
+        indexes = np.arange(len(vertices))
+    return build_node(vertices, normals, base, width, indexes, max_triangles, min_width)
+
+def shared_arrays(context, vertices, normals):
+    """ Returns the triangles' vertices and normals copied into RawArrays for init_worker """
+    raws = []
+    for array in (vertices, normals):
+        raw = context.RawArray("d", array.size)
+        np.frombuffer(raw)[:] = array.ravel()
+        raws.append(raw)
+    return raws
+
+def plan_node(vertices, normals, base, width, indexes, max_triangles, min_width,
+        split_threshold, tasks):
+    """
+    Appends the build_task arguments needed to build the node to tasks. Returns the index
+    of the task that builds the node, or a tuple of the plans of its children if the node
+    is a branch whose cube intersects more than split_threshold triangles, so its children
+    are built separately. indexes can be None for all the triangles.
+    """
+    base = np.asarray(base, dtype=np.float64)
+    num_indexes = len(vertices) if indexes is None else len(indexes)
+    if split_threshold is not None and num_indexes > split_threshold:
+        if indexes is None:
+            indexes = np.arange(len(vertices))
+        indexes = indexes[triangles_intersect_box(vertices[indexes], normals[indexes],
+                base + width / 2, width / 2)]
+        if len(indexes) > max(split_threshold, max_triangles) and width >= 2 * min_width:
+            return tuple(plan_node(vertices, normals, base + offset * (width / 2), width / 2,
+                    indexes, max_triangles, min_width, split_threshold, tasks)
+                    for offset in CHILD_OFFSETS)
+
+    tasks.append((tuple(base), width, indexes))
+    return len(tasks) - 1
+
+def fill_plan(plan, results):
+    """ Returns the node for the plan returned by plan_node given the results of the tasks """
+    if isinstance(plan, tuple):
+        return tuple(fill_plan(p, results) for p in plan)
+    return results[plan]
+
+def build_cells(vertices, normals, cells, max_triangles, min_width, *,
+        pool=None, split_threshold=None):
+    """
+    Returns the nodes of the cells, in the same order. cells is a list of
+    (base, width). If pool is a pool started with init_worker for the same mesh, the
+    cells are built by its processes, and so are the subtrees whose cubes intersect
+    more than split_threshold triangles. The nodes are the same either way.
+    """
+    if pool is None:
+        indexes = np.arange(len(vertices))
+        return [build_node(vertices, normals, base, width, indexes, max_triangles, min_width)
+                for base, width in cells]
+
+    tasks = []
+    plans = [plan_node(vertices, normals, base, width, None, max_triangles, min_width,
+            split_threshold, tasks) for base, width in cells]
+    results = pool.starmap(build_task, tasks)
+    return [fill_plan(p, results) for p in plans]
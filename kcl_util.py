@@ -1,4 +1,9 @@
+import multiprocessing
+import numpy as np
+import os
+import struct
 from .util import *
+from .kcl_build import CHILD_OFFSETS, build_cells, shared_arrays
 from math import log2, ceil, floor
 
 class KclTriangle:
@@ -116,6 +121,11 @@ class KclTriangle:
 class KclMesh:
     def __init__(self, triangles):
         self.triangles = triangles
+        # For testing many triangles at once
+        self.vertices = np.array([[tuple(v) for v in t.vertices] for t in triangles],
+                dtype=np.float64).reshape(-1, 3, 3)
+        self.normals = np.array([tuple(t.normal) for t in triangles],
+                dtype=np.float64).reshape(-1, 3)
         self.vertex_list = []
         self.normal_list = []
         vertex_map = {}
@@ -131,21 +141,42 @@ class KclMesh:
         return bytestr
 
 
+def octree_building_pool(mesh, max_triangles, min_width, processes=None):
+    """
+    Returns (pool, build_cells) where pool is a multiprocessing pool whose processes
+    have the mesh's triangles in shared memory, and build_cells is kcl_build.build_cells
+    in a form that can use it (see spawn_pool).
+    Returns (None, build_cells) if processes can't be started.
+    """
+    try:
+        pool, kcl_build = spawn_pool("kcl_build", processes, "init_worker",
+                shared_arrays(multiprocessing.get_context("spawn"),
+                    mesh.vertices, mesh.normals) + [max_triangles, min_width])
+        return pool, kcl_build.build_cells
+    except (OSError, ValueError) as e:
+        print("Couldn't start octree building processes:", e)
+        return None, build_cells
+
+
 # Taken from SM64DSe
 class Octree:
-    def create(mesh, max_triangles, min_width):
+    def create(mesh, max_triangles, min_width, *, use_processes=False, split_threshold=None):
         """
         Returns an octree where the cube of each leaf node intersects less than
         max_triangles of the triangles, unless that would make the width of the cube
         less than min_width.
+        If use_processes is set, the top-level cells are built in separate processes, and
+        so are the subtrees whose cubes intersect more than split_threshold triangles.
+        split_threshold defaults to the number of triangles over 4 times the number of CPUs.
+        The octree is the same either way.
         """
         self = Octree()
         self.triangles = mesh.triangles
         self.max_triangles = max_triangles
         self.min_width = min_width
 
-        min_c = [min(v[i] for t in mesh.triangles for v in t.vertices) for i in range(3)]
-        max_c = [max(v[i] for t in mesh.triangles for v in t.vertices) for i in range(3)]
+        min_c = mesh.vertices.min(axis=(0, 1)).tolist()
+        max_c = mesh.vertices.max(axis=(0, 1)).tolist()
         
         # If model only uses two axes, eg. flat square, 
         # the base width will get set to min_width (1)
@@ -168,24 +199,39 @@ class Octree:
 
         self.num_c = [int(floor(self.widths[i] / self.base_width)) for i in range(3)]
 
-        indexes = list(range(len(mesh.triangles)))
-        self.children = []
-
-        for k in range(self.num_c[2]):
-            for j in range(self.num_c[1]):
-                for i in range(self.num_c[0]):
-                    self.children.append(Octree.child(
-                        self.base + Vector((i, j, k)) * self.base_width,
-                        self.base_width, indexes, mesh.triangles,
-                        max_triangles, min_width, 0))
-
+        cells = [(self.base + Vector((i, j, k)) * self.base_width, self.base_width)
+                for k in range(self.num_c[2])
+                for j in range(self.num_c[1])
+                for i in range(self.num_c[0])]
+
+        pool = None
+        build = build_cells
+        if use_processes:
+            pool, build = octree_building_pool(mesh, max_triangles, min_width)
+            if split_threshold is None:
+                split_threshold = max(max_triangles,
+                        len(mesh.triangles) // (4 * (os.cpu_count() or 1)))
+
+        try:
+            nodes = build(mesh.vertices, mesh.normals, [(tuple(b), w) for b, w in cells],
+                    max_triangles, min_width, pool=pool, split_threshold=split_threshold)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        self.children = [Octree.from_node(node, base, width, mesh, max_triangles, min_width, 0)
+                for node, (base, width) in zip(nodes, cells)]
         return self
 
-    def child(base, width, indexes, triangles, max_triangles, min_width, depth):
+    def from_node(node, base, width, mesh, max_triangles, min_width, depth):
+        """
+        Returns the octree for the node returned by kcl_build.build_node, whose cube
+        has the given base and width.
+        """
         self = Octree()
-        center = base + Vector((width,) * 3) / 2
         self.width = width
-        self.triangles = triangles
+        self.triangles = mesh.triangles
         self.max_triangles = max_triangles
         self.min_width = min_width
         self.depth = depth # Just for debugging
@@ -195,25 +241,14 @@ class Octree:
 
         self.base = Vector((width / 2,) * 3)
         self.real_base = base # for debugging
-        self.indexes = []
-        for i in indexes:
-            if triangles[i].intersects_box(center, width / 2):
-                self.indexes.append(i)
 
         # self.add_debug_mesh()
-        self.is_leaf = True
-        self.children = []
-        if len(self.indexes) > max_triangles and width >= 2 * min_width:
-            for k in range(2):
-                for j in range(2):
-                    for i in range(2):
-                        self.children.append(Octree.child(
-                            base + Vector((i, j, k)) / 2 * width,
-                            width / 2, self.indexes, triangles,
-                            max_triangles, min_width, depth + 1))
-
-            self.indexes.clear()
-            self.is_leaf = False
+        self.is_leaf = not isinstance(node, tuple)
+        self.indexes = node if self.is_leaf else []
+        self.children = [] if self.is_leaf else [Octree.from_node(child,
+                base + Vector(offset) / 2 * width, width / 2,
+                mesh, max_triangles, min_width, depth + 1)
+                for child, offset in zip(node, CHILD_OFFSETS)]
 
         return self
 
@@ -233,27 +268,64 @@ class Octree:
         obj.scale = Vector((self.width,) * 3)
         obj.modifiers.new("Wireframe", "WIREFRAME")
 
-    def export(self):
+    def shared_suffix_lists(leaf_lists):
+        """
+        Returns (list_offsets, stored, size) where list_offsets maps each of the leaves'
+        index lists to the offset of its list, stored is a list of (offset, indexes) of the
+        lists to write, and size is the size they take up.
+        The indexes of each list are ordered so that the triangles in the most lists come
+        last, and a list that ends another one is stored as part of it instead of on its own.
+        """
+        counts = {}
+        for indexes in leaf_lists:
+            for index in indexes:
+                counts[index] = counts.get(index, 0) + 1
+        ordered = {indexes: tuple(sorted(indexes, key=lambda i: (counts[i], i)))
+                for indexes in leaf_lists}
+
+        # A list ends another list if its reverse starts the other's reverse, and then it
+        # also starts the reverse that comes right after it in sorted order
+        reverses = sorted(o[::-1] for o in ordered.values())
+        containers = list(range(len(reverses)))
+        for i in reversed(range(len(reverses) - 1)):
+            if reverses[i + 1][:len(reverses[i])] == reverses[i]:
+                containers[i] = containers[i + 1]
+
+        stored = []
+        starts = {}
+        size = 0
+        for i, r in enumerate(reverses):
+            if containers[i] == i:
+                starts[i] = size
+                stored.append((size, r[::-1]))
+                size += 2 * (len(r) + 1)
+
+        # The lists that end other lists start partway into them
+        reverse_offsets = {r: starts[c] + 2 * (len(reverses[c]) - len(r))
+                for r, c in zip(reverses, containers)}
+        list_offsets = {indexes: reverse_offsets[o[::-1]] for indexes, o in ordered.items()}
+        return list_offsets, stored, size
+
+    def export(self, share_suffixes=False):
+        """
+        Returns the octree section. If share_suffixes is set, leaves whose triangle lists
+        end the lists of other leaves point into those instead of getting their own.
+        """
         branches = [self]
         free_list_offset = 0
-        list_offsets_idx = []
-        list_offsets_addr = []
+        list_offsets = {} # Maps the indexes of each leaf to the offset of its list
 
         # Not a for loop because branches may get extra elements it has to deal with
         i = 0
         while i < len(branches):
             for node in branches[i].children:
                 if node.is_leaf:
-                    if len(node.indexes) == 0:
+                    key = tuple(node.indexes)
+                    if len(key) == 0 or key in list_offsets:
                         continue
 
-                    if node.indexes in list_offsets_idx:
-                        continue
-                    
-                    #print(node.indexes)
-                    list_offsets_idx.append(node.indexes)
-                    list_offsets_addr.append(free_list_offset)
-                    free_list_offset += 2 * (len(node.indexes) + 1)
+                    list_offsets[key] = free_list_offset
+                    free_list_offset += 2 * (len(key) + 1)
 
                 else:
                     branches.append(node)
@@ -264,36 +336,46 @@ class Octree:
         for b in branches:
             list_base += 4 * len(b.children)
 
-        list_offsets_idx.append([])
-        list_offsets_addr.append(free_list_offset - 2)
+        if share_suffixes:
+            list_offsets, stored, size = Octree.shared_suffix_lists(list(list_offsets))
+            print("Sharing triangle list suffixes saved {} of {} bytes of lists".format(
+                free_list_offset - size, free_list_offset))
+            free_list_offset = size
+        else:
+            stored = [(offset, indexes) for indexes, offset in list_offsets.items()]
+
+        # Empty leaves point to the terminator of the last list
+        list_offsets[()] = free_list_offset - 2
         branch_base = 0
         free_branch_offset = 4 * len(self.children)
 
-        bytestr = bytearray()
+        bytestr = bytearray(list_base + free_list_offset)
 
         for branch in branches:
+            words = []
             for node in branch.children:
                 if node.is_leaf:
-                    key = list_offsets_idx.index(node.indexes)
-                    bytestr += from_uint(1 << 31 | 
-                            (list_base + list_offsets_addr[key] - 2 - branch_base), 4)
+                    words.append(1 << 31 |
+                            (list_base + list_offsets[tuple(node.indexes)] - 2 - branch_base))
                 else:
-                    bytestr += from_uint(free_branch_offset - branch_base, 4)
+                    words.append(free_branch_offset - branch_base)
                     free_branch_offset += 4 * len(node.children)
 
+            struct.pack_into("<{}I".format(len(words)), bytestr, branch_base, *words)
             branch_base += 4 * len(branch.children)
 
-        del list_offsets_idx[-1]
-        del list_offsets_addr[-1]
-
-        for indexes in list_offsets_idx:
-            for index in indexes:
-                bytestr += from_uint(index + 1, 2)
-            bytestr += from_uint(0, 2)
+        # The lists are already terminated since the buffer starts out zeroed
+        for offset, indexes in stored:
+            struct.pack_into("<{}H".format(len(indexes)), bytestr, list_base + offset,
+                    *[index + 1 for index in indexes])
 
         return bytestr
 
-    def import_(bytestr):
+    def import_(bytestr, debug_meshes=True):
+        """
+        Returns the octree of the KCL. The leaves' indexes are the 0-based indexes of
+        their triangles. If debug_meshes is set, a cube is added to the scene for each node.
+        """
         self = Octree()
 
         self.base = Vector(to_vec(bytestr, 0x14, 4, 3, 6))
@@ -309,11 +391,11 @@ class Octree:
                     self.children.append(Octree.import_child(bytestr, addr,
                             addr + 4 * ((k * self.num_c[1] + j) * self.num_c[0] + i),
                             self.base + Vector((i, j, k)) * self.base_width,
-                            self.base_width, 0))
+                            self.base_width, 0, debug_meshes))
         
         return self
 
-    def import_child(bytestr, grid_offset, offset, base, width, depth):
+    def import_child(bytestr, grid_offset, offset, base, width, depth, debug_meshes=True):
         self = Octree()
         self.real_base = base
         self.width = width
@@ -321,16 +403,19 @@ class Octree:
 
         word = to_uint(bytestr, offset, 4)
 
-        self.add_debug_mesh()
+        if debug_meshes:
+            self.add_debug_mesh()
 
         self.children = []
         if word >> 31 & 1:
             self.is_leaf = True
             self.triangles = []
+            self.indexes = []
 
             tri_addr = grid_offset + word % 2 ** 31 + 2
             tri_index = to_uint(bytestr, tri_addr, 2)
             while tri_index != 0:
+                self.indexes.append(tri_index - 1)
                 tri_addr += 2
                 tri_index = to_uint(bytestr, tri_addr, 2)
 
@@ -343,7 +428,7 @@ class Octree:
                             grid_offset + word,
                             grid_offset + word + 4 * ((k * 2 + j) * 2 + i),
                             base + Vector((i, j, k)) * width / 2,
-                            width / 2, depth + 1))
+                            width / 2, depth + 1, debug_meshes))
 
         return self
 
@@ -0,0 +1,330 @@
+import bpy
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+from contextlib import contextmanager
+from math import degrees
+from pathlib import PurePath
+from .util import *
+from .bmd_reader import BmdFile, MappedFile
+from .tex_util import decode_rgba5555
+from . import export_bmd, export_bca, export_kcl, import_bmd
+from .import_bca import decode_anim
+from .kcl_util import KclTriangle, Octree
+
+# Exports the selection to BMD, the active object to KCL and the active armature's
+# animation to BCA, all in memory, then reads the results back and checks them against
+# the scene and against golden files, timing each stage. Run it in Blender with the
+# addon enabled:
+#   blender scene.blend --background --python-expr \
+#       "import sm256e.roundtrip as r; r.main()" -- <golden directory> [--update]
+# Exits with status 1 if a check fails.
+
+class Timings:
+    def __init__(self):
+        self.seconds = {} # maps stage name to seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+
+
+def compare_golden(bytestr, golden_path, update=False):
+    """ Returns a dict describing how bytestr compares to the golden file.
+    If update is True, the golden file is replaced with bytestr instead. """
+    result = {"sha1": hashlib.sha1(bytestr).hexdigest(), "bytes": len(bytestr)}
+    if update:
+        with open(golden_path, "wb") as f:
+            f.write(bytestr)
+        result["golden"] = "updated"
+        return result
+
+    if not os.path.exists(golden_path):
+        result["golden"] = "missing"
+        return result
+
+    with open(golden_path, "rb") as f:
+        golden = f.read()
+    result["golden_sha1"] = hashlib.sha1(golden).hexdigest()
+    result["golden"] = "same" if golden == bytestr else "different"
+    if golden != bytestr:
+        result["first_difference"] = next((i for i, (a, b) in
+                enumerate(zip(golden, bytestr)) if a != b), min(len(golden), len(bytestr)))
+    return result
+
+def unmatched_points(points, others, tolerance):
+    """ Returns the number of rows of points that aren't within tolerance of any row
+    of others, checking each coordinate separately. Both are integer arrays. """
+    if len(points) == 0:
+        return 0
+    if len(others) == 0:
+        return len(points)
+
+    unmatched = 0
+    # Sorted by x, so only a window of others has to be checked for each point
+    order = np.argsort(others[:, 0], kind="mergesort")
+    others = others[order]
+    lo = np.searchsorted(others[:, 0], points[:, 0] - tolerance, side="left")
+    hi = np.searchsorted(others[:, 0], points[:, 0] + tolerance, side="right")
+    for point, l, h in zip(points, lo, hi):
+        if not (np.abs(others[l:h] - point) <= tolerance).all(axis=1).any():
+            unmatched += 1
+    return unmatched
+
+def with_file(bytestr, suffix, open_):
+    """ Writes bytestr to a temporary file and returns open_(path), since the readers
+    work on files """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytestr)
+        return open_(path)
+    finally:
+        os.remove(path)
+
+
+def check_bmd(context, bytestr, tolerance, pixel_tolerance):
+    """ Returns (checks, failures) for the BMD exported from the selection """
+    meshes, bones = export_bmd.get_selection(context)
+    checks = {}
+    failures = []
+
+    def read(path):
+        with BmdFile(path) as bmd:
+            parsed = import_bmd.ParsedBmd(bmd)
+            geos = []
+            bone = parsed.skeleton.bones[0]
+            while bone:
+                geos.append(parsed.get_geometry(bmd, bone))
+                bone = bone.sibling
+
+            materials = [(cstr_to_str(bmd.bytestr, to_uint(m, 0, 4)), to_int(m, 4, 4))
+                    for m in bmd.table("materials")]
+            textures = []
+            for tex_bytes, pal_bytes in zip(bmd.table("textures"), bmd.table("palettes")):
+                tex_param = to_uint(tex_bytes, 0x10, 4)
+                type_ = tex_param >> 26 & 7
+                size = to_uint(tex_bytes, 8, 4)
+                if type_ == Texture.COMPRESSED:
+                    size = size * 3 // 2
+                tex_data = bytes(get_n_bytes(bmd.bytestr, to_uint(tex_bytes, 4, 4), size))
+                pal_data = bytes(get_n_bytes(bmd.bytestr, to_uint(pal_bytes, 4, 4),
+                        to_uint(pal_bytes, 8, 4)))
+                textures.append((cstr_to_str(bmd.bytestr, to_uint(tex_bytes, 0, 4)),
+                    decode_rgba5555(tex_data, pal_data, to_uint(tex_bytes, 0xc, 2),
+                        to_uint(tex_bytes, 0xe, 2), type_, tex_param >> 29 & 1)))
+            return parsed.scale_factor, geos, materials, textures
+
+    scale_factor, geos, materials, textures = with_file(bytestr, ".bmd", read)
+
+    # Vertex positions, as 4.12 fixed point at the BMD's scale
+    used = {(i, v) for i, m in enumerate(meshes) for p in m.polygons for v in p.vertices}
+    offsets = np.cumsum([0] + [len(m.vertices) for m in meshes])
+    positions = export_bmd.get_vertex_positions(meshes, bones)
+    expected = np.array([[fix_to_int(c / 2 ** scale_factor, 12)
+            for c in positions[offsets[i] + v]] for i, v in sorted(used)],
+            dtype=np.int64).reshape(-1, 3)
+    actual = np.concatenate([np.asarray(g.positions, dtype=np.int64).reshape(-1, 3)
+            for g in geos]) if geos else np.zeros((0, 3), dtype=np.int64)
+    checks["vertices"] = {"expected": len(expected), "read": len(actual),
+            "unexpected": unmatched_points(actual, expected, tolerance),
+            "missing": unmatched_points(expected, actual, tolerance)}
+    if checks["vertices"]["unexpected"] or checks["vertices"]["missing"]:
+        failures.append("BMD vertices don't match the meshes")
+
+    # Materials
+    expected_materials = [(mat.name, bool(mat.texture_slots[0])) for m in meshes
+            for mat in m.materials]
+    actual_materials = [(name, texture_id >= 0) for name, texture_id in materials]
+    checks["materials"] = {"expected": len(expected_materials), "read": len(actual_materials),
+            "same": expected_materials == actual_materials}
+    if expected_materials != actual_materials:
+        failures.append("BMD materials don't match the meshes' materials")
+
+    # Texture pixels, as RGBA5555. Colors of fully transparent texels don't matter.
+    checks["textures"] = {}
+    for name, rgba5555 in textures:
+        image = bpy.data.images[name]
+        source = np.floor(np.array(image.pixels[:]).reshape(-1, 4) * 31 + 0.5).astype(np.int32)
+        diff = np.abs(source - rgba5555)
+        diff[(source[:, 3] == 0) & (rgba5555[:, 3] == 0), 0:3] = 0
+        checks["textures"][name] = {"mean_error": float(diff.mean()),
+                "max_error": int(diff.max())}
+        if diff.mean() > pixel_tolerance:
+            failures.append("BMD texture {} differs from its image by {:.3f} on average"
+                    .format(name, diff.mean()))
+
+    return checks, failures
+
+def check_kcl(context, bytestr, scale, tolerance):
+    """ Returns (checks, failures) for the KCL exported from the active object """
+    obj = context.active_object
+    mesh = obj.to_mesh(context.scene, True, "RENDER")
+    expected = np.array([[fix_to_int(c * scale, 6) for c in v.co] for v in mesh.vertices],
+            dtype=np.int64).reshape(-1, 3)
+    num_tris = sum(len(p.vertices) - 2 for p in mesh.polygons)
+    bpy.data.meshes.remove(mesh)
+
+    def read(path):
+        with MappedFile(path) as kcl:
+            t_addr, o_addr = struct.unpack_from("<II", kcl.bytestr, 0x8)
+            # Triangle indexes start at 1
+            tris = [KclTriangle.import_(kcl.bytestr, offset)
+                    for offset in range(t_addr + 0x10, o_addr, 0x10)]
+            return tris, Octree.import_(kcl.bytestr, debug_meshes=False)
+
+    tris, octree = with_file(bytestr, ".kcl", read)
+    # The first vertex of each triangle is stored as is. The others are worked out from
+    # the normals, so they aren't exact.
+    vertices = np.array([[fix_to_int(c, 6) for c in t.vertices[0]] for t in tris],
+            dtype=np.int64).reshape(-1, 3)
+
+    leaves = []
+    nodes = list(octree.children)
+    while nodes:
+        node = nodes.pop()
+        if node.is_leaf:
+            leaves.append(node)
+        nodes += node.children
+    in_leaves = {i for leaf in leaves for i in leaf.indexes}
+
+    checks = {"triangles": {"expected": num_tris, "read": len(tris)},
+            "vertices": {"read": len(vertices),
+                "unexpected": unmatched_points(vertices, expected, tolerance)},
+            "octree": {"leaves": len(leaves),
+                "bad_indexes": sum(not 0 <= i < len(tris) for i in in_leaves),
+                "triangles_in_no_leaf": len(set(range(len(tris))) - in_leaves)}}
+
+    failures = []
+    if num_tris != len(tris):
+        failures.append("KCL has {} triangles instead of {}".format(len(tris), num_tris))
+    if checks["vertices"]["unexpected"]:
+        failures.append("KCL vertices don't match the mesh")
+    if checks["octree"]["bad_indexes"]:
+        failures.append("KCL octree refers to triangles that don't exist")
+    if checks["octree"]["triangles_in_no_leaf"]:
+        failures.append("KCL octree leaves out some triangles")
+    return checks, failures
+
+def check_bca(context, bytestr, tolerance):
+    """ Returns (checks, failures) for the BCA exported from the active armature """
+    obj = context.active_object
+    scene = context.scene
+    current = scene.frame_current
+    expected = []
+    for frame in range(scene.frame_start, scene.frame_end + 1):
+        scene.frame_set(frame)
+        expected.append([[fix_to_int(c, 12) for c in b.matrix.to_scale()] +
+                [deg_to_int(degrees(e)) for e in b.matrix.to_euler("XYZ")] +
+                [fix_to_int(c, 12) for c in b.matrix.to_translation()]
+                for b in obj.pose.bones])
+    scene.frame_set(current)
+    expected = np.array(expected, dtype=np.int64).transpose(1, 2, 0)
+
+    num_bones, num_frames, values = decode_anim(bytes(bytestr))
+    checks = {"bones": num_bones, "frames": num_frames}
+    failures = []
+    if values.shape != expected.shape:
+        failures.append("BCA has {} bones and {} frames instead of {} and {}".format(
+            num_bones, num_frames, expected.shape[0], expected.shape[2]))
+        return checks, failures
+
+    diff = np.abs(values - expected)
+    # Rotations wrap around
+    diff[:, 3:6] = np.minimum(diff[:, 3:6] % 65536, -diff[:, 3:6] % 65536)
+    if not diff.size:
+        return checks, failures
+
+    checks["max_error"] = {"scale": int(diff[:, 0:3].max()),
+            "rotation": int(diff[:, 3:6].max()),
+            "translation": int(diff[:, 6:9].max())}
+    if diff.max() > tolerance:
+        failures.append("BCA values differ from the sampled poses by up to {}".format(
+            int(diff.max())))
+    return checks, failures
+
+
+def run(context, golden_dir, *, update=False, bmd=True, kcl=True, bca=True,
+        tolerance=1, pixel_tolerance=2.0, kcl_scale=1.0):
+    """
+    Exports, reads back and checks each format whose source exists in the scene.
+    tolerance is in units of the last bit of the encoded values, and pixel_tolerance
+    is the mean error allowed per texel channel, out of 31.
+    Returns (results, failures).
+    """
+    stem = PurePath(bpy.data.filepath).stem or "untitled"
+    results = {}
+    failures = []
+    obj = context.active_object
+
+    def check(kind, export, check_):
+        timings = Timings()
+        with timings.stage("export"):
+            bytestr = export()
+        with timings.stage("golden"):
+            result = compare_golden(bytestr, os.path.join(golden_dir, stem + "." + kind), update)
+        with timings.stage("check"):
+            result["checks"], kind_failures = check_(bytes(bytestr))
+        result["seconds"] = timings.seconds
+        results[kind] = result
+
+        failures.extend(kind_failures)
+        if result["golden"] == "different":
+            failures.append("{} differs from the golden file at byte {:#x}".format(
+                kind.upper(), result["first_difference"]))
+
+    if bmd and any(o.type == "MESH" for o in context.selected_objects):
+        check("bmd", lambda: export_bmd.export_model(context)[0],
+                lambda b: check_bmd(context, b, tolerance, pixel_tolerance))
+    if kcl and obj and obj.type == "MESH":
+        check("kcl", lambda: export_kcl.export_mesh(context, obj, scale=kcl_scale),
+                lambda b: check_kcl(context, b, kcl_scale, tolerance))
+    if bca and obj and obj.type == "ARMATURE":
+        check("bca", lambda: export_bca.export_anim(context, obj),
+                lambda b: check_bca(context, b, tolerance))
+
+    return results, failures
+
+def main(argv=None):
+    import argparse
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+
+    parser = argparse.ArgumentParser(prog="roundtrip",
+            description="Checks the exporters' output against the scene and golden files")
+    parser.add_argument("golden_dir")
+    parser.add_argument("--update", action="store_true",
+            help="Replace the golden files with the current output")
+    parser.add_argument("--json", help="File to write the results and timings to")
+    parser.add_argument("--tolerance", type=int, default=1)
+    parser.add_argument("--pixel-tolerance", type=float, default=2.0)
+    parser.add_argument("--kcl-scale", type=float, default=1.0)
+    parser.add_argument("--skip", action="append", default=[], choices=["bmd", "kcl", "bca"])
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.golden_dir, exist_ok=True)
+    results, failures = run(bpy.context, args.golden_dir, update=args.update,
+            bmd="bmd" not in args.skip, kcl="kcl" not in args.skip, bca="bca" not in args.skip,
+            tolerance=args.tolerance, pixel_tolerance=args.pixel_tolerance,
+            kcl_scale=args.kcl_scale)
+
+    for kind, result in sorted(results.items()):
+        print("{}: {} bytes, sha1 {}, golden {}; {}".format(kind.upper(), result["bytes"],
+            result["sha1"], result["golden"], ", ".join("{} {:.3f}s".format(stage, s)
+                for stage, s in sorted(result["seconds"].items()))))
+    for failure in failures:
+        print("FAILED:", failure)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "failures": failures}, f, indent=4, sort_keys=True)
+
+    if failures:
+        sys.exit(1)
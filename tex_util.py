@@ -0,0 +1,97 @@
+import numpy as np
+
+# Doesn't import bpy, so texture data can be decoded outside of Blender.
+# Texture types, same as in Texture
+A3I5 = 1
+COLOR_4 = 2
+COLOR_16 = 3
+COLOR_256 = 4
+COMPRESSED = 5
+A5I3 = 6
+COLOR_DIRECT = 7
+
+def rgb555_array(uint16s):
+    """ Returns an array of (r, g, b) rows, each 0-31, from an array of RGB555 colors """
+    return uint16s.astype(np.int32)[:, None] >> np.array([0, 5, 10]) & 0x1f
+
+def decode_palette(pal_bytestr, min_colors):
+    """ Returns the palette as an array of (r, g, b, a) rows, each 0-31.
+    The palette is padded with (0, 0, 0, 0) so it has at least min_colors colors. """
+    colors = np.frombuffer(pal_bytestr, dtype="<u2", count=len(pal_bytestr) // 2) \
+            if pal_bytestr else np.zeros(0, dtype=np.uint16)
+    palette = np.zeros((max(len(colors), min_colors), 4), dtype=np.int32)
+    palette[:len(colors), 0:3] = rgb555_array(colors)
+    palette[:len(colors), 3] = 31
+    return palette
+
+def decode_alpha(tex_bytestr, palette, width, height, alpha_bits):
+    texels = np.frombuffer(tex_bytestr, dtype=np.uint8, count=width * height).astype(np.int32)
+    rgba = palette[texels % 2 ** (8 - alpha_bits)].copy()
+    rgba[:, 3] = np.floor((texels >> (8 - alpha_bits)) * 31 / (2 ** alpha_bits - 1) + 0.5)
+    return rgba
+
+def decode_ncol(tex_bytestr, palette, width, height, index_bits, transparency):
+    if transparency:
+        palette[0] = 0
+
+    texels = np.frombuffer(tex_bytestr, dtype=np.uint8,
+            count=width * height * index_bits // 8).astype(np.int32)
+    indexes = texels[:, None] >> index_bits * np.arange(8 // index_bits) & \
+            2 ** index_bits - 1
+    return palette[indexes.ravel()]
+
+def decode_direct(tex_bytestr, width, height):
+    texels = np.frombuffer(tex_bytestr, dtype="<u2", count=width * height)
+    rgba = np.empty((width * height, 4), dtype=np.int32)
+    rgba[:, 0:3] = rgb555_array(texels)
+    rgba[:, 3] = 31 * (texels >> 15)
+    return rgba
+
+def decode_compressed(tex_bytestr, palette, width, height):
+    num_blocks = width * height // 16
+    texels = np.frombuffer(tex_bytestr, dtype="<u4", count=num_blocks).astype(np.int64)
+    pal_ints = np.frombuffer(tex_bytestr, dtype="<u2", count=num_blocks,
+            offset=width * height // 4).astype(np.int32)
+
+    pal_indexes = np.minimum(pal_ints % 2 ** 14 * 2, len(palette) - 4)
+    interp = (pal_ints >> 14 & 1).astype(np.bool_)[:, None]
+    transparency = ~(pal_ints >> 15 & 1).astype(np.bool_)[:, None]
+
+    # The 4 colors of each block
+    c0, c1, c2, c3 = (palette[pal_indexes + i] for i in range(4))
+    colors = np.stack([c0, c1,
+        np.where(transparency,
+            np.where(interp, (c0 + c1) // 2, c2),
+            np.where(interp, (c0 * 5 + c1 * 3) // 8, c2)),
+        np.where(transparency, 0,
+            np.where(interp, (c0 * 3 + c1 * 5) // 8, c3))], axis=1)
+
+    indexes = texels[:, None] >> 2 * np.arange(16) & 3
+    rgba = colors[np.arange(num_blocks)[:, None], indexes]
+
+    # Blocks are stored row by row, and so are the texels in a block
+    return rgba.reshape(height // 4, width // 4, 4, 4, 4) \
+            .transpose(0, 2, 1, 3, 4).reshape(width * height, 4)
+
+def decode_rgba5555(tex_bytestr, pal_bytestr, width, height, type_, transparency):
+    """ Returns the texels of the texture in order as an array of (r, g, b, a) rows,
+    each 0-31. """
+    # Padded so that out-of-range indexes get (0, 0, 0, 0)
+    palette = decode_palette(pal_bytestr, 256 if type_ != COMPRESSED else 4)
+
+    if type_ in (A3I5, A5I3):
+        return decode_alpha(tex_bytestr, palette, width, height, 3 if type_ == A3I5 else 5)
+
+    elif type_ in (COLOR_4, COLOR_16, COLOR_256):
+        return decode_ncol(tex_bytestr, palette, width, height,
+                2 if type_ == COLOR_4 else 4 if type_ == COLOR_16 else 8, transparency)
+
+    elif type_ == COLOR_DIRECT:
+        return decode_direct(tex_bytestr, width, height)
+
+    elif type_ == COMPRESSED:
+        return decode_compressed(tex_bytestr, np.concatenate(
+            [palette, np.zeros((4, 4), dtype=np.int32)]), width, height)
+
+    else:
+        raise Exception("Unknown type: " + hex(type_))
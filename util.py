@@ -1,8 +1,15 @@
 import bpy
 import bmesh
+import importlib
+import multiprocessing
+import numpy as np
+import os
+import sys
+from array import array
 from mathutils import Color, Vector
 from functools import reduce
 from itertools import permutations, takewhile, chain
+from .tex_util import decode_rgba5555
 
 def int_round_mid_up(num):
     return int((num + 0.5) // 1)
@@ -52,7 +59,7 @@ def cstr_to_str(bytestr, offset):
     end = offset
     while bytestr[end] != 0x00:
         end += 1
-    return bytestr[offset : end].decode("ascii")
+    return bytes(bytestr[offset : end]).decode("ascii")
 
 def from_int(integer, num_bytes):
     return integer.to_bytes(num_bytes, byteorder="little", signed=True)
@@ -93,6 +100,31 @@ def color_to_uint16(color, gamma, scale=1):
 def str_to_cstr(string):
     return string.encode("ascii") + b'\0'
 
+# Number of bytes of parameters each GX command takes
+GX_PARAM_SIZES = {
+    0x00: 0, 0x10: 4, 0x11: 0, 0x12: 4, 0x13: 4, 0x14: 4, 0x15: 0,
+    0x16: 64, 0x17: 48, 0x18: 64, 0x19: 48, 0x1a: 36, 0x1b: 12, 0x1c: 12,
+    0x20: 4, 0x21: 4, 0x22: 4, 0x23: 8, 0x24: 4, 0x25: 4, 0x26: 4, 0x27: 4,
+    0x28: 4, 0x29: 4, 0x2a: 4, 0x2b: 4,
+    0x30: 4, 0x31: 4, 0x32: 4, 0x33: 4, 0x34: 128,
+    0x40: 4, 0x41: 0, 0x50: 4, 0x60: 4, 0x70: 12, 0x71: 8, 0x72: 4,
+}
+
+def gx_commands(data_bytes):
+    """ Yields (command, offset) for each command in the display list data,
+    where offset is the offset of the command's parameters. """
+    offset = 0
+    while offset < len(data_bytes):
+        cmds = data_bytes[offset : offset + 4]
+        offset += 4
+
+        for cmd in cmds:
+            if cmd not in GX_PARAM_SIZES:
+                raise Exception("Unknown GX command: " + hex(cmd) +
+                        " at offset: " + hex(offset))
+            yield cmd, offset
+            offset += GX_PARAM_SIZES[cmd]
+
 class Vertex:
     def __init__(self, position, normal, uv, color, group):
         """
@@ -111,6 +143,18 @@ class Vertex:
     def rep(self):
         return (self.position, self.normal, self.uv, self.color, self.group)
 
+    def quantized_rep(self, tex_size):
+        """ Returns the rep of this vertex as the values it gets encoded as in a
+        display list, so vertices that encode identically have equal reps.
+        tex_size: (int, int) is the size of the texture the UVs get scaled by
+        """
+        return (tuple(fix_to_int(c, 12) for c in self.position) if self.position else None,
+                from_vecb(self.normal * 511 / 512, 10, 9, 4) if self.normal else None,
+                (fix_to_int(self.uv[0] * tex_size[0], 4),
+                    fix_to_int(self.uv[1] * tex_size[1], 4)) if self.uv else None,
+                color_to_uint16(self.color, 1) if self.color else None,
+                self.group)
+
     def from_rep(rep):
         return Vertex(*rep)
 
@@ -140,22 +184,36 @@ class Face:
         return (len(self.vertices) == 3 or 2 not in diffs) and diffs[0] != diffs[1]
 
 class Geometry:
-    def __init__(self, vertices, faces, compute_face_graph = True):
+    def __init__(self, vertices, faces, compute_face_graph = True, tex_size = None):
         """
         vertices: [Vertex]
         faces: [Face]
         face_graph: [{int}] says which faces are connected to which faces by index
+        tex_size: (int, int) | None is the texture size. If given, vertices are
+            compared by the values they get encoded as instead of their exact values.
         """
         self.vertices = vertices[:]
         self.faces = faces[:]
 
         if compute_face_graph:
             # Vertices with equal reps are equivalent, so make them identical
-            by_rep = {v.rep(): v for v in self.vertices}
+            get_rep = (lambda v: v.quantized_rep(tex_size)) if tex_size else Vertex.rep
+            reps = {v: get_rep(v) for v in self.vertices}
+            by_rep = {rep: v for v, rep in reps.items()}
             self.vertices = list(by_rep.values())
 
             for face in self.faces:
-                face.vertices = [by_rep[v.rep()] for v in face.vertices]
+                face.vertices = [by_rep[reps[v]] for v in face.vertices]
+
+            if tex_size:
+                # Merged corners become one, so a quad with 2 merged corners is a triangle.
+                # Faces with fewer than 3 corners left, or that fold back onto themselves,
+                # collapsed into lines or points and can't be seen anyway.
+                for face in self.faces:
+                    face.vertices = [v for i, v in enumerate(face.vertices) \
+                            if v is not face.vertices[i - 1]]
+                self.faces = [f for f in self.faces \
+                        if len(f.vertices) >= 3 and len(set(f.vertices)) == len(f.vertices)]
 
             self.face_graph = [{j for j, other in enumerate(self.faces) \
                 if face.can_connect_to(other)} for face in self.faces]
@@ -255,12 +313,61 @@ class Geometry:
 
         return (tri_strips, quad_strips, tris, quads)
 
-    def create_mesh(self, context, name, skeleton, scale):
-        get_equiv = lambda v: (v.position, v.normal, v.group)
+class ImportedGeometry:
+    def __init__(self):
+        """
+        Geometry read from display lists, stored as flat arrays of the encoded values.
+        positions: array of x, y, z of each vertex as 4.12 fixed point
+        normals: array of x, y, z of each vertex's normal as 1.9 fixed point
+        has_normal: array of whether each vertex has a normal
+        tex_coords: array of s, t of each vertex as 12.4 fixed point
+        has_tex_coords: array of whether each vertex has texture coordinates
+        colors: array of the RGB555 color of each vertex
+        has_color: array of whether each vertex has a color
+        groups: array of the group of each vertex
+        loops: array of the vertex index of each face corner
+        face_sizes: array of the number of vertices of each face
+        material_ids: array of the material of each face
+        """
+        self.positions = array("i")
+        self.normals = array("i")
+        self.has_normal = array("b")
+        self.tex_coords = array("i")
+        self.has_tex_coords = array("b")
+        self.colors = array("H")
+        self.has_color = array("b")
+        self.groups = array("i")
+        self.loops = array("i")
+        self.face_sizes = array("b")
+        self.material_ids = array("i")
+
+    def num_vertices(self):
+        return len(self.groups)
+
+    def has_normals(self, material_id):
+        """ Whether any face with the material has a vertex with a normal """
+        counter = 0
+        for size, face_material_id in zip(self.face_sizes, self.material_ids):
+            if face_material_id == material_id and \
+                    any(self.has_normal[v] for v in self.loops[counter : counter + size]):
+                return True
+            counter += size
+        return False
 
-        equiv = {}
-        for v in self.vertices:
-            equiv.setdefault(get_equiv(v), []).append(v)
+    def create_mesh(self, context, name, skeleton, scale):
+        positions = zip(*[iter(self.positions)] * 3)
+        normals = zip(*[iter(self.normals)] * 3)
+        get_equiv = lambda p, n, h, g: (p, n if h else None, g)
+
+        # Maps each equivalence class to the index of the vertex that represents it
+        new_indexes = {}
+        equiv_vertices = []
+        vertex_map = array("i")
+        for equiv in map(get_equiv, positions, normals, self.has_normal, self.groups):
+            if equiv not in new_indexes:
+                new_indexes[equiv] = len(equiv_vertices)
+                equiv_vertices.append(equiv)
+            vertex_map.append(new_indexes[equiv])
 
         mesh = bpy.data.meshes.new(name)
         obj = bpy.data.objects.new(name, mesh)
@@ -269,37 +376,52 @@ class Geometry:
         context.scene.objects.active = obj
         obj.select = True
 
-        equiv_vertices = [v for v in self.vertices if equiv[get_equiv(v)][0] == v]
-        vertices = [skeleton.bones[v.group].abs_transform * (scale * v.position) 
-                for v in equiv_vertices]
-        faces = [[equiv_vertices.index(equiv[get_equiv(v)][0]) for v in f.vertices]
-                for f in self.faces]
-        
-        mesh.from_pydata(vertices, [], faces)
-
-        for face in mesh.polygons:
-            face.use_smooth = True
-
-        # UV
-        if any(v.uv for v in self.vertices):
-            mesh.uv_textures.new("UVMap")
-            uvs = [v.uv if v.uv else Vector((0, 0)) 
-                    for f in self.faces for v in f.vertices]
-
-            for i, data in enumerate(mesh.uv_layers[0].data):
-                data.uv = uvs[i]
+        # Transform all the vertices by their bones' transforms at once
+        transforms = np.array([[list(row) for row in b.abs_transform] for b in skeleton.bones])
+        groups = np.array([g for _, _, g in equiv_vertices], dtype=np.int32)
+        coords = np.array([p for p, _, _ in equiv_vertices], dtype=np.float64).reshape(-1, 3)
+        coords *= scale / 4096
+        coords = np.einsum("vij,vj->vi", transforms[groups, :3, :3], coords) + \
+                transforms[groups, :3, 3]
+
+        loops = np.asarray(vertex_map, dtype=np.int32)[np.asarray(self.loops, dtype=np.int32)]
+        face_sizes = np.asarray(self.face_sizes, dtype=np.int32)
+        loop_starts = np.cumsum(face_sizes, dtype=np.int32) - face_sizes
+
+        mesh.vertices.add(len(coords))
+        mesh.vertices.foreach_set("co", coords.astype(np.float32).ravel())
+        mesh.loops.add(len(loops))
+        mesh.loops.foreach_set("vertex_index", loops)
+        mesh.polygons.add(len(face_sizes))
+        mesh.polygons.foreach_set("loop_start", loop_starts)
+        mesh.polygons.foreach_set("loop_total", face_sizes)
+        mesh.polygons.foreach_set("use_smooth", np.ones(len(face_sizes), dtype=np.bool_))
+        mesh.update(calc_edges=True)
 
         # Vertex colors
-        if any(v.color for v in self.vertices):
+        if any(self.has_color):
             mesh.vertex_colors.new("Col")
-            colors = [v.color if v.color else Color((1, 1, 1))
-                    for f in self.faces for v in f.vertices]
-
-            for i, data in enumerate(mesh.vertex_colors[0].data):
-                data.color = colors[i]
+            mesh.vertex_colors[0].data.foreach_set("color", self.loop_colors())
 
         return obj
 
+    def loop_colors(self):
+        """ Returns the flat array of the color of each face corner, white if there's none """
+        loops = np.asarray(self.loops, dtype=np.int32)
+        colors = np.asarray(self.colors, dtype=np.int32)[loops]
+        rgb = (colors[:, None] >> np.array([0, 5, 10]) & 0x1f) / 31
+        rgb[np.asarray(self.has_color, dtype=np.bool_)[loops] == False] = 1
+        return rgb.astype(np.float32).ravel()
+
+    def loop_uvs(self, loop_sizes):
+        """ Returns the flat array of the UV of each face corner, (0, 0) if there's none.
+        loop_sizes: numpy array of the size of the texture at each face corner
+        """
+        loops = np.asarray(self.loops, dtype=np.int32)
+        uvs = np.asarray(self.tex_coords, dtype=np.int32).reshape(-1, 2)[loops] / 16
+        uvs[np.asarray(self.has_tex_coords, dtype=np.bool_)[loops] == False] = 0
+        return (uvs / loop_sizes).astype(np.float32).ravel()
+
 
 class Bone:
     def __init__(self, name, parent_id, sibling_id, rel_transform, material_ids, displist_ids):
@@ -486,6 +608,9 @@ class Texture:
     A5I3 = 6
     COLOR_DIRECT = 7
 
+    NAMES = {A3I5: "A3I5", COLOR_4: "4-color", COLOR_16: "16-color", COLOR_256: "256-color",
+            COMPRESSED: "compressed", A5I3: "A5I3", COLOR_DIRECT: "direct"}
+
     def calc_rgba5555(self):
         self.rgba5555 = [tuple(int_round_mid_up(c * 31) for c in \
                 self.texture.image.pixels[4 * i : 4 * i + 4]) for i in \
@@ -651,99 +776,42 @@ class Texture:
         print(texture.image.name, "DONE")
         return tex
 
-    def get_colors(indexes, palette):
-        return [palette[index] for index in indexes]
-
-    def calc_rgba5555_alpha(self, num_alpha_bits):
-        self.rgba5555 = [self.palette[v % 2 ** (8 - num_alpha_bits)][0:3] +
-                [int_round_mid_up((v >> (8 - num_alpha_bits)) * 31 / (2 ** num_alpha_bits - 1))]
-                for v in to_uint_list(self.tex_bytestr, 0, 1, self.width * self.height)]
-
-    def calc_rgba5555_ncol(self, index_bits):
-        if self.transparency:
-            self.palette[0] = [0, 0, 0, 0]
-
-        indexes = [(v >> index_bits * i) % 2 ** index_bits
-                for v in to_uint_list(self.tex_bytestr, 0, 1, 
-                    self.width * self.height // (8 // index_bits))
-                for i in range(8 // index_bits)]
-        self.rgba5555 = Texture.get_colors(indexes, self.palette)
-
-    def calc_rgba5555_direct(self):
-        self.rgba5555 = [uint16_to_rgb555(c) + [31 * (c >> 15)] for c in
-                to_uint_list(self.tex_bytestr, 0, 2, self.width * self.height)]
-
-    def calc_rgba5555_compressed(self):
-        self.rgba5555 = [None for _ in range(self.width * self.height)]
-        pal_index_offset = self.width * self.height // 4
-        self.palette += [[0, 0, 0, 0] for i in range(2)] # in case of optimization
-
-        for y in range(self.height // 4):
-            for x in range(self.width // 4):
-                texel_int = to_uint(self.tex_bytestr, (y * (self.width // 4) + x) * 4, 4)
-                texel = [texel_int >> (2 * i) & 3 for i in range(16)]
-
-                pal_int = to_uint(self.tex_bytestr,
-                        pal_index_offset + (y * (self.width // 4) + x) * 2, 2)
-                pal_index = (pal_int % 2 ** 14) * 2
-                interp = pal_int >> 14 & 1
-                transparency = not (pal_int >> 15 & 1)
-
-                colors = self.palette[pal_index:][:2] + [None] * 2
-                if transparency:
-                    colors[3] = [0, 0, 0, 0]
-                    colors[2] = [int_round_mid_up((c0 + c1) // 2) for c0, c1 in
-                            zip(colors[0], colors[1])] \
-                                    if interp else self.palette[pal_index + 2]
-
-                elif interp:
-                    colors[2] = [int_round_mid_up((c0 * 5 + c1 * 3) // 8) for c0, c1 in
-                            zip(colors[0], colors[1])] 
-                    colors[3] = [int_round_mid_up((c0 * 3 + c1 * 5) // 8) for c0, c1 in
-                            zip(colors[0], colors[1])] 
-
-                else:
-                    for i in range(2,4):
-                        colors[i] = self.palette[pal_index + i]
-
-                texel_colors = Texture.get_colors(texel, colors)
-                for i in range(4):
-                    offset = (4 * y + i) * self.width + 4 * x
-                    self.rgba5555[offset : offset + 4] = texel_colors[4 * i:][:4]
-                    
-
-    def calc_bpy_texture(self, name):
+    def decode_args(self):
+        """ Returns the arguments to decode_rgba5555 that decode this texture """
+        return (self.tex_bytestr, self.pal_bytestr,
+                self.width, self.height, self.type, self.transparency)
+
+    def decode(self):
+        """ Returns the decoded texels. Doesn't use bpy, so this can run in another thread. """
+        return decode_rgba5555(*self.decode_args())
+
+    def set_pixels(self, rgba5555):
+        """ Fills in the image with the decoded texels """
+        self.rgba5555 = rgba5555
+        # Whether any texel isn't fully opaque, so materials don't have to scan the image
+        self.uses_alpha = bool((self.rgba5555[:, 3] < 31).any())
+        self.texture.image.pixels[:] = (self.rgba5555 / 31).ravel().tolist()
+
+    def calc_bpy_texture(self, name, decode=True):
+        """ If decode is False, the image is left blank and uses_alpha is None
+        until set_pixels gets called. """
         self.texture = bpy.data.textures.new(name, "IMAGE")
-        if self.pal_bytestr:
-            self.palette = [uint16_to_rgb555(c) + [31] for c in 
-                    to_uint_list(self.pal_bytestr, 0, 2, len(self.pal_bytestr) // 2)]
-
-        if self.type in (Texture.A3I5, Texture.A5I3): 
-            self.calc_rgba5555_alpha(3 if self.type == Texture.A3I5 else 5) 
-
-        elif self.type in (Texture.COLOR_4, Texture.COLOR_16, Texture.COLOR_256):
-            self.calc_rgba5555_ncol(2 if self.type == Texture.COLOR_4 else
-                    4 if self.type == Texture.COLOR_16 else 8)
-
-        elif self.type == Texture.COLOR_DIRECT:
-            self.calc_rgba5555_direct()
-
-        elif self.type == Texture.COMPRESSED:
-            self.calc_rgba5555_compressed()
-
-        else:
+        if self.type not in Texture.NAMES:
             raise Exception("Unknown type: " + hex(self.type) + 
                     " in texture: " + name)
 
         image = bpy.data.images.new(name, self.width, self.height, True)
         image.colorspace_settings.name = "sRGB"
-        image.pixels = [v / 31 for c in self.rgba5555 for i, v in enumerate(c)]
         self.texture.image = image
+        self.uses_alpha = None
+        if decode:
+            self.set_pixels(self.decode())
 
         if self.type in (Texture.COLOR_16, Texture.COLOR_256, Texture.COLOR_DIRECT):
             self.texture["Uncompressed"] = 1
 
-    def from_bytestr(tex_bytestr, pal_bytestr, name, width, height, type_, transparency):
+    def from_bytestr(tex_bytestr, pal_bytestr, name, width, height, type_, transparency,
+            decode=True):
         tex = Texture()
         tex.tex_bytestr = tex_bytestr
         tex.pal_bytestr = pal_bytestr
@@ -751,10 +819,50 @@ class Texture:
         tex.height = height
         tex.type = type_
         tex.transparency = transparency
-        tex.calc_bpy_texture(name)
+        tex.calc_bpy_texture(name, decode)
         return tex
 
 
+def spawn_pool(module_name, processes=None, initializer=None, initargs=()):
+    """
+    Returns (pool, module) where pool is a multiprocessing pool and module is the
+    addon's module with the given name, imported as a top-level module so that its
+    functions can be sent to the pool's processes. The processes run Blender's Python,
+    not Blender, and can't import the addon itself since its __init__ needs bpy.
+    initializer is the name of a function of the module that each process runs with
+    initargs. The addon's directory is only on sys.path while the module is imported
+    and the processes start, so the addon's other modules don't become importable
+    as top-level modules for the rest of the session.
+    Raises OSError or ValueError if the processes can't be started.
+    """
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    added = addon_dir not in sys.path
+    if added:
+        sys.path.append(addon_dir)
+    try:
+        module = importlib.import_module(module_name)
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(bpy.app.binary_path_python)
+        return context.Pool(processes, initializer and getattr(module, initializer),
+                initargs), module
+    finally:
+        if added:
+            sys.path.remove(addon_dir)
+
+def texture_decoding_pool(processes=None):
+    """
+    Returns (pool, decode) where pool is a multiprocessing pool and decode is
+    decode_rgba5555 in a form its processes can run (see spawn_pool).
+    Returns (None, decode_rgba5555) if processes can't be started.
+    """
+    try:
+        pool, tex_util = spawn_pool("tex_util", processes)
+        return pool, tex_util.decode_rgba5555
+    except (OSError, ValueError) as e:
+        print("Couldn't start texture decoding processes:", e)
+        return None, decode_rgba5555
+
+
 class AlignedBytes:
     def __init__(self, bytestr, byte_align):
         """
@@ -806,6 +914,9 @@ class BytesWithPtrs:
                     % byte_align * b"\0", position))
             position += len(placed_bytestrs[-1][0])
 
+        # Where each bytestring ended up, for anything that wants to inspect the layout
+        self.positions = [p for _, p in placed_bytestrs]
+
         for src_index, src_offset, dest_index, dest_offset, num_bytes in indexed_ptrs:
             placed_bytestrs[src_index][0][src_offset : src_offset + num_bytes] = \
                     from_uint(placed_bytestrs[dest_index][1] + dest_offset, num_bytes)